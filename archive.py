@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+測定データの保管ディレクトリの読み込みと索引
+
+gen_csv_header()/CsvSession が書いたCSV(と runfile.py のバイナリ形式)を対象にする。
+データ部は1行ずつオブジェクトを作らず、まとめて分割して float の配列に変換する。
+索引(開始時刻, memo, 点数, 磁界の最小/最大, 更新時刻)はディレクトリ内の INDEX_FILE に保存し、
+更新時刻かサイズの変わったファイルだけを読み直す。
+"""
+import csv
+import datetime
+import glob
+import json
+import os
+import sys
+from array import array
+
+import runfile
+
+INDEX_FILE = ".sweep_index.json"
+START_FORMAT = '%Y-%m-%d_%H-%M-%S'
+FIELD_COLUMN = 3  # 磁界:H[Gauss]
+
+
+class SweepData:
+    """
+    1回分の測定データ
+    columns[k] は k列目の値の配列
+    """
+
+    def __init__(self, filename: str, start: str, memo: str, end: str, labels: list, columns: list):
+        self.filename = filename
+        self.start = start
+        self.memo = memo
+        self.end = end
+        self.labels = labels
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+
+    @property
+    def start_time(self):
+        return datetime.datetime.strptime(self.start, START_FORMAT) if self.start else None
+
+    def column(self, label: str) -> array:
+        """
+        --------
+        :param label: 列見出し "磁界:H[Gauss]" または見出しの先頭部分 "磁界"
+        """
+        for k, name in enumerate(self.labels):
+            if name == label or name.startswith(label):
+                return self.columns[k]
+        raise KeyError(label)
+
+
+def load_csv(filename: str) -> SweepData:
+    """
+    CSVを読み込む
+
+    Raise
+    -----
+    ValueError : 測定データの形式でないとき
+    """
+    start = memo = end = ""
+    labels = None
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("開始時刻,"):
+                start = next(csv.reader([line]))[1]
+            elif line.startswith("memo,"):
+                memo = next(csv.reader([line]))[1]
+            elif line.startswith("経過時間"):
+                labels = next(csv.reader([line]))
+                break
+        if labels is None:
+            raise ValueError("{}: header not found".format(filename))
+        body = f.read()
+
+    footer = body.rfind("終了時刻,")
+    if footer >= 0:
+        end = next(csv.reader([body[footer:].split("\n", 1)[0]]))[1]
+        body = body[:footer]
+    body = body.strip()
+    width = len(labels)
+    if not body:
+        return SweepData(filename, start, memo, end, labels, [array('d') for _ in range(width)])
+    flat = array('d', map(float, body.replace("\n", ",").split(",")))
+    if len(flat) % width:
+        raise ValueError("{}: ragged data rows".format(filename))
+    columns = [flat[k::width] for k in range(width)]
+    return SweepData(filename, start, memo, end, labels, columns)
+
+
+def load_run(filename: str) -> SweepData:
+    with runfile.RunFile(filename) as run:
+        columns = [array('d', run.column(name)) for name in runfile.COLUMNS]
+        return SweepData(filename, run.meta["start"], run.meta["memo"], run.meta.get("end") or "",
+                         run.meta["labels"], columns)
+
+
+def load(filename: str) -> SweepData:
+    if filename.endswith(".run"):
+        return load_run(filename)
+    return load_csv(filename)
+
+
+class ArchiveIndex:
+    """
+    保管ディレクトリの索引
+    """
+
+    def __init__(self, directory: str = "."):
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_FILE)
+        self.entries = {}  # ファイル名 => 索引項目
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def update(self) -> int:
+        """
+        変更のあったファイルだけ読み直して索引を保存する
+
+        --------
+        :return: 読み直したファイル数
+        """
+        found = set()
+        parsed = 0
+        for path in glob.glob(os.path.join(self.directory, "*.csv")) + glob.glob(os.path.join(self.directory, "*.run")):
+            name = os.path.basename(path)
+            stat = os.stat(path)
+            found.add(name)
+            entry = self.entries.get(name)
+            if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                continue
+            parsed += 1
+            try:
+                data = load(path)
+            except (OSError, ValueError, KeyError):
+                self.entries[name] = {"mtime": stat.st_mtime, "size": stat.st_size, "valid": False}
+                continue
+            field = data.columns[FIELD_COLUMN] if len(data) and len(data.columns) > FIELD_COLUMN else []
+            self.entries[name] = {"mtime": stat.st_mtime, "size": stat.st_size, "valid": True,
+                                  "start": data.start, "memo": data.memo, "end": data.end, "rows": len(data),
+                                  "field_min": min(field) if field else None,
+                                  "field_max": max(field) if field else None}
+        for name in set(self.entries) - found:
+            del self.entries[name]
+        self.save()
+        return parsed
+
+    def save(self) -> None:
+        temp = self.path + ".tmp"
+        with open(temp, mode="w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(temp, self.path)
+
+    def query(self, memo: str = None, since: datetime.datetime = None, until: datetime.datetime = None,
+              field_min: float = None, field_max: float = None) -> list:
+        """
+        条件に合う測定のファイル名を開始時刻順に返す
+
+        --------
+        :param memo:      memoに含まれる文字列
+        :param since:     この時刻以降に開始した測定
+        :param until:     この時刻以前に開始した測定
+        :param field_min: 磁界がこの値以下まで振れている測定
+        :param field_max: 磁界がこの値以上まで振れている測定
+        """
+        result = []
+        for name, entry in self.entries.items():
+            if not entry.get("valid"):
+                continue
+            if memo is not None and memo not in entry["memo"]:
+                continue
+            if since is not None or until is not None:
+                try:
+                    start = datetime.datetime.strptime(entry["start"], START_FORMAT)
+                except ValueError:
+                    continue
+                if since is not None and start < since or until is not None and start > until:
+                    continue
+            if field_min is not None and (entry["field_min"] is None or entry["field_min"] > field_min):
+                continue
+            if field_max is not None and (entry["field_max"] is None or entry["field_max"] < field_max):
+                continue
+            result.append(name)
+        return sorted(result, key=lambda n: self.entries[n]["start"])
+
+    def load(self, name: str) -> SweepData:
+        return load(os.path.join(self.directory, name))
+
+
+if __name__ == '__main__':
+    index = ArchiveIndex(sys.argv[1] if len(sys.argv) > 1 else ".")
+    print("{} files parsed".format(index.update()))
+    for name in index.query(memo=sys.argv[2] if len(sys.argv) > 2 else None):
+        entry = index.entries[name]
+        print("{}  {:>5} rows  H {}..{}  {}".format(entry["start"], entry["rows"], entry["field_min"],
+                                                   entry["field_max"], entry["memo"]))
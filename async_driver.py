@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio 版の機器操作と掃引
+
+VISA の呼び出しはブロッキングなので、バスごとに1本のスレッドで実行し await で待つ。
+同じバスへのコマンドは必ず同じスレッドで順に実行されるので、同期版の関数と混ざることはない。
+
+掃引では記録点のステータス取得が終わった時点で次の点へのランプを始め、
+CSVへの書き込みと画面表示はその裏で行う。
+磁界の読み取りは次のISET書き込みより前に終えるので、測定値そのものは同期版と変わらない。
+"""
+import asyncio
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import helmcoil
+import planner
+
+
+class AsyncRig:
+    """
+    ガウスメーターとバイポーラ電源の非同期操作
+    """
+
+    def __init__(self):
+        self._power_bus = ThreadPoolExecutor(max_workers=1, thread_name_prefix="power-bus")
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="record")
+
+    def close(self) -> None:
+        self._power_bus.shutdown()
+        self._io.shutdown()
+
+    async def _power(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._power_bus, func, *args)
+
+    async def _gauss(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(helmcoil._gauss_executor(), func, *args)
+
+    async def fetch_iout(self) -> float:
+        return await self._power(helmcoil.FetchIout)
+
+    async def fetch_iset(self) -> float:
+        return await self._power(helmcoil.FetchIset)
+
+    async def fetch_vout(self) -> float:
+        return await self._power(helmcoil.FetchVout)
+
+    async def fetch_ifine(self) -> int:
+        return await self._power(helmcoil.FetchIFine)
+
+    async def fetch_field(self) -> float:
+        return await self._gauss(helmcoil.FetchField)
+
+    async def set_iset(self, i: float) -> None:
+        await self._power(helmcoil.SetIset, i)
+
+    async def set_iset_ma(self, current: int) -> None:
+        await self._power(helmcoil.SetIsetMA, current)
+
+    async def ramp_to(self, current: int, target: int, step: int) -> None:
+        await self._power(helmcoil.ramp_to, current, target, step)
+
+    async def set_ifine(self, fine: int) -> None:
+        await self._power(helmcoil.SetIFine, fine)
+
+    async def load_status(self) -> helmcoil.StatusList:
+        """
+        loadStatus() と同じ内容を2つのバスで並行して取得する
+        """
+        def power_side() -> tuple:
+            return (helmcoil._timed_fetch(helmcoil.FetchIout), helmcoil._timed_fetch(helmcoil.FetchIset),
+                    helmcoil._timed_fetch(helmcoil.FetchVout), helmcoil._timed_fetch(helmcoil.FetchIFine))
+
+        (iout, iset, vout, ifine), field = await asyncio.gather(
+            self._power(power_side), self._gauss(helmcoil._timed_fetch, helmcoil.FetchFieldStats))
+        result = helmcoil.StatusList()
+        result.iout, result.iset, result.vout, result.ifine = iout[0], iset[0], vout[0], ifine[0]
+        result.field, result.field_std, result.field_count = field[0]
+        result.acquired = {"iout": iout[1], "iset": iset[1], "vout": vout[1], "ifine": ifine[1], "field": field[1]}
+        return result
+
+    async def wait_settle(self, target: int, condition: helmcoil.SettleCondition = helmcoil.POINT_SETTLE) -> float:
+        """
+        helmcoil.wait_settle() の非同期版
+        IOUTとFIELDは別のバスなので同時に問い合わせる
+        """
+        tracker = helmcoil.SettleTracker(target, condition)
+        while True:
+            helmcoil.WATCHDOG.check()
+            now = time.monotonic()
+            if condition.field_slope is not None:
+                current, field = await asyncio.gather(self.fetch_iout(), self.fetch_field())
+            else:
+                current, field = await self.fetch_iout(), 0.0
+            if tracker.update(now, current * 1000, field):
+                return tracker.elapsed
+            wait = condition.poll - (time.monotonic() - now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def record(self, session, status: helmcoil.StatusList, echo: bool) -> None:
+        """
+        CSVへの書き込みと表示 ファイル操作は専用スレッドで行う
+        """
+        if echo:
+            print(status)
+        await asyncio.get_running_loop().run_in_executor(self._io, session.add_status, status)
+
+
+async def run_plan(rig: AsyncRig, plan: planner.SweepPlan, session,
+                   start_time: datetime.datetime, settle: helmcoil.SettleCondition = helmcoil.POINT_SETTLE,
+                   echo: bool = False) -> None:
+    """
+    helmcoil.run_plan() の非同期版
+    記録点のCSV書き込みと表示を次の点へのランプと重ねる 書き込む点とランプは helmcoil.plan_writes() / ramp_to() と同じ
+    """
+    with helmcoil.WATCHDOG:
+        await _run_plan(rig, plan, session, start_time, settle, echo)
+
+
+async def _run_plan(rig: AsyncRig, plan: planner.SweepPlan, session, start_time: datetime.datetime,
+                    settle: helmcoil.SettleCondition, echo: bool) -> None:
+    pending = []
+    try:
+        written = helmcoil.A_to_mA(await rig.fetch_iset())
+        for k, ramp_step in helmcoil.plan_writes(plan, written):
+            current = plan.iset[k]
+            await rig.ramp_to(written, current, ramp_step)
+            await rig.set_iset_ma(current)
+            written = current
+            if not plan.log[k]:
+                await rig.wait_settle(current, helmcoil.RAMP_SETTLE)
+                continue
+            settle_time = await rig.wait_settle(current, settle)
+            status = await rig.load_status()
+            status.set_origine_time(start_time)
+            status.settle_second = settle_time
+            pending.append(asyncio.ensure_future(rig.record(session, status, echo)))
+            for task in [task for task in pending if task.done()]:
+                task.result()  # 書き込みの失敗をここで表に出す
+            pending = [task for task in pending if not task.done()]
+    finally:
+        # WATCHDOG で止まったときも、書き込み中の記録を終えてからセッションを閉じさせる
+        if pending:
+            await asyncio.gather(*pending)
+
+
+async def Oe_measure_async(check_point: list = None, mesh: int = 10, step: int = 150) -> None:
+    """
+    Oe_measure() の非同期版
+    """
+    if check_point is None:
+        check_point = [100, -100, 100]
+    try:
+        helmcoil.allow_power_output(True)
+    except helmcoil.ControlError:
+        print("[FATAL]バイポーラ電源制御エラー!!")
+        return
+    helmcoil.set_gauss_range(300)
+    helmcoil.ctl_magnetic_field(0)
+    plan = planner.field_plan(check_point, mesh, step, helmcoil.fields_to_ma, helmcoil.oe_to_ma(0))
+    print(plan)
+
+    basename = helmcoil.get_time_str() + "磁歪"
+    memo = helmcoil.input_memo()
+    rig = AsyncRig()
+    try:
+        with helmcoil.open_session(basename) as session:
+            start_time = session.write_header(memo)
+            await run_plan(rig, plan, session, start_time, helmcoil.POINT_FIELD_SETTLE, echo=True)
+    except helmcoil.ControlError as e:
+        print(e.message)
+        return
+    finally:
+        rig.close()
+    helmcoil.return_to_zero(check_point[-1])
+    print("Done")
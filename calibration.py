@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+磁界-電流 校正表
+
+実測した (磁界, 電流) の組を増加側・減少側の2系統で持ち、区分線形補間で磁界から設定電流を求める。
+ファイルはCSVで、1行目は見出し、以降は 系統(up/down), 磁界[Oe], 電流[mA] の順に並べる。
+
+    branch,field[Oe],current[mA]
+    up,-100,-4790
+    up,0,-12
+    up,100,4771
+    down,100,4771
+    down,0,12
+    down,-100,-4790
+"""
+import csv
+from bisect import bisect_left
+
+UP = 1
+DOWN = -1
+
+
+class Branch:
+    """
+    1系統の校正点 磁界の昇順に並べて持つ
+    """
+
+    def __init__(self, points: list):
+        points = sorted(points)
+        self.field = [p[0] for p in points]
+        self.current = [p[1] for p in points]
+
+    def __len__(self) -> int:
+        return len(self.field)
+
+    def interpolate(self, field: float) -> float:
+        """
+        --------
+        :param field: 磁界[Oe]
+        :return: 電流[mA]
+
+        Raise
+        -----
+        ValueError : 校正範囲外のとき
+        """
+        fields = self.field
+        if not fields[0] <= field <= fields[-1]:
+            raise ValueError("{} Oe is out of calibration range [{}, {}]".format(field, fields[0], fields[-1]))
+        k = bisect_left(fields, field)
+        if fields[k] == field:
+            return self.current[k]
+        f0, f1 = fields[k - 1], fields[k]
+        i0, i1 = self.current[k - 1], self.current[k]
+        return i0 + (i1 - i0) * (field - f0) / (f1 - f0)
+
+
+class FieldCalibration:
+    """
+    増加側・減少側の校正表
+    """
+
+    def __init__(self, up: list, down: list = None, filename: str = ""):
+        """
+        --------
+        :param up:   増加側の [(磁界[Oe], 電流[mA]), ...]
+        :param down: 減少側 Noneの場合は増加側と同じ
+        """
+        self.up = Branch(up)
+        self.down = Branch(down) if down else self.up
+        self.filename = filename
+        if len(self.up) < 2 or len(self.down) < 2:
+            raise ValueError("calibration needs at least 2 points per branch")
+
+    @classmethod
+    def load(cls, filename: str) -> "FieldCalibration":
+        up, down = [], []
+        with open(filename, encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if not row or row[0].startswith("#"):
+                    continue
+                point = (float(row[1]), float(row[2]))
+                if row[0].strip().lower() == "down":
+                    down.append(point)
+                else:
+                    up.append(point)
+        return cls(up, down, filename)
+
+    def current(self, field: float, direction: int = UP) -> int:
+        """
+        --------
+        :param field:     磁界[Oe]
+        :param direction: UP(増加中) / DOWN(減少中)
+        :return: 電流[mA]
+        """
+        branch = self.down if direction == DOWN else self.up
+        return int(round(branch.interpolate(field)))
+
+    def currents(self, fields: list, direction: int = UP) -> list:
+        """
+        磁界の列をまとめて電流に換算する
+        各点の系統は前の点との大小から決める 先頭は次の点との大小、変化がなければ直前の系統を引き継ぐ
+
+        --------
+        :param fields:    磁界[Oe]の列
+        :param direction: 系統が決まらない場合の既定値
+        :return: 電流[mA]の列
+        """
+        result = []
+        previous = None
+        for k, field in enumerate(fields):
+            if previous is not None and field != previous:
+                direction = UP if field > previous else DOWN
+            elif previous is None and len(fields) > 1 and fields[1] != field:
+                direction = UP if fields[1] > field else DOWN
+            result.append(self.current(field, direction))
+            previous = field
+        return result
+
+
+def linear(oe_per_a: float, limit: float) -> FieldCalibration:
+    """
+    コイル定数だけから作る直線の校正表
+
+    --------
+    :param oe_per_a: コイル定数[Oe/A]
+    :param limit:    校正範囲[Oe]
+    """
+    points = [(-limit, -limit / oe_per_a * 1000), (limit, limit / oe_per_a * 1000)]
+    return FieldCalibration(points, points, "")
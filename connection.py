@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+機器への接続の管理
+
+pyvisa の import と機器のオープンは最初に問い合わせたときまで遅らせるので、
+解析用のツールなど機器に触らないものは pyvisa も実機もなしに helmcoil を import できる。
+開いたハンドルは機器ごとに1つを使い回し、同じ機器へのアクセスはロックで1つずつ行う。
+タイムアウトなどの通信エラーでは閉じて開き直し、待ち時間を倍にしながら再試行する。
+"""
+import threading
+import time
+
+import tracing
+
+RETRIES = 3      # 通信エラー時の再試行回数
+BACKOFF = 0.5    # 最初の再試行までの待ち[sec] 以降は倍にする
+
+_resource_manager = None
+_manager_lock = threading.Lock()
+# 開き直して再試行する例外 pyvisa を import したら VisaIOError を加える
+RETRYABLE = (OSError, TimeoutError)
+
+
+def resource_manager():
+    """
+    pyvisa の ResourceManager 最初の呼び出しで pyvisa を import する
+    """
+    global _resource_manager, RETRYABLE
+    with _manager_lock:
+        if _resource_manager is None:
+            try:
+                import pyvisa as visa
+            except ImportError:
+                import visa
+            RETRYABLE = (OSError, TimeoutError, visa.VisaIOError)
+            _resource_manager = visa.ResourceManager()
+    return _resource_manager
+
+
+def open_visa(address: str):
+    return resource_manager().open_resource(address)
+
+
+class Connection:
+    """
+    1台の機器への接続
+    pyvisa の Resource と同じ query()/write() を持つので、そのまま protocol.query() などに渡せる
+    """
+
+    def __init__(self, name: str, address: str, probe_command: str, opener=open_visa,
+                 retries: int = RETRIES, backoff: float = BACKOFF):
+        """
+        --------
+        :param name:          "power" または "gauss"
+        :param address:       VISAアドレス "GPIB0::4::INSTR"
+        :param probe_command: probe() で送る問い合わせ
+        :param opener:        address を受け取って Resource を返す関数
+        :param retries:       通信エラー時の再試行回数
+        :param backoff:       最初の再試行までの待ち[sec]
+        """
+        self.name = name
+        self.address = address
+        self.probe_command = probe_command
+        self.opener = opener
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.RLock()
+        self.reconnects = 0
+        self.errors = 0
+        self.last_error = None
+        self.latency = None  # 直近の probe() の往復時間[sec]
+        self._resource = None
+
+    def __repr__(self) -> str:
+        return "Connection({!r}, {!r})".format(self.name, self.address)
+
+    @property
+    def connected(self) -> bool:
+        return self._resource is not None
+
+    def resource(self):
+        """
+        開いているハンドル まだ開いていなければ開く
+        """
+        with self.lock:
+            if self._resource is None:
+                self._resource = self.opener(self.address)
+            return self._resource
+
+    def close(self) -> None:
+        with self.lock:
+            resource, self._resource = self._resource, None
+            if resource is not None:
+                try:
+                    resource.close()
+                except RETRYABLE:
+                    pass
+
+    def _call(self, method: str, *args):
+        with self.lock:
+            attempt = 0
+            while True:
+                try:
+                    return getattr(self.resource(), method)(*args)
+                except RETRYABLE as e:
+                    self.errors += 1
+                    self.last_error = "{}: {}".format(type(e).__name__, e)
+                    self.close()
+                    if attempt >= self.retries:
+                        raise
+                    wait = self.backoff * 2 ** attempt
+                    print("[WARN]{} 通信エラー {} ({:.1f}秒後に再接続)".format(self.name, self.last_error, wait))
+                    with tracing.span("reconnect", self.name, self.address):
+                        time.sleep(wait)
+                    attempt += 1
+                    self.reconnects += 1
+
+    def query(self, command: str) -> str:
+        return self._call("query", command)
+
+    def write(self, command: str):
+        return self._call("write", command)
+
+    def read(self) -> str:
+        return self._call("read")
+
+    def probe(self) -> bool:
+        """
+        probe_command を1回だけ問い合わせて応答があるか確かめる 再試行はしない
+        往復時間を latency に記録する
+        """
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                self.resource().query(self.probe_command)
+            except RETRYABLE as e:
+                self.errors += 1
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+                self.latency = None
+                self.close()
+                return False
+            self.latency = time.perf_counter() - start
+            return True
+
+    def report(self) -> str:
+        return "{:<6} {:<18} {:<9} latency= {} reconnects= {} errors= {} last= {}".format(
+            self.name, self.address, "open" if self.connected else "closed",
+            "-" if self.latency is None else "{:.1f}ms".format(self.latency * 1000),
+            self.reconnects, self.errors, self.last_error or "-")
+
+
+def simulated_rig(**rig_params) -> tuple:
+    """
+    シミュレータへの接続 最初に使うときに simulator.open_simulated_rig() で2台をまとめて作る
+
+    --------
+    :param rig_params: open_simulated_rig() に渡すパラメータ
+    :return: (gauss, power)
+    """
+    rig = []
+
+    def opener(index: int):
+        def open_simulated(address: str):
+            with _manager_lock:
+                if not rig:
+                    import simulator
+
+                    rig.extend(simulator.open_simulated_rig(**rig_params))
+            return rig[index]
+        return open_simulated
+
+    return (Connection("gauss", "SIM::MODEL421", "*IDN?", opener(0)),
+            Connection("power", "SIM::PBX40-10", "IDN?", opener(1)))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+連続掃引測定
+
+ISETを一定の速さ[mA/sec]で連続的に動かしながら、
+電源側(IOUT, VOUT)とガウスメーター側(FIELD)をそれぞれのバスの限界の速さで読み続ける。
+測定後、各FIELD読み取り時刻のIOUT/VOUTを補間して (t, ISET, IOUT, FIELD, VOUT) の組を作り、
+指定した磁界の格子点ごとにまとめてCSVに記録する。
+
+電源側は1本のスレッドでISET書き込みとIOUT/VOUT読み取りを交互に行うので、GPIBへのアクセスが重なることはない。
+"""
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import helmcoil
+
+WRITE_INTERVAL = 0.05  # ISET書き込み間隔[sec]
+
+
+class Trajectory:
+    """
+    ISETの時間変化 折り返し点の間を一定の速さで直線的に動く
+    """
+
+    def __init__(self, currents: list, rate: float):
+        """
+        --------
+        :param currents: 折り返し電流[mA] 先頭は開始電流
+        :param rate:     掃引速度[mA/sec]
+        """
+        self.currents = currents
+        self.rate = abs(rate)
+        self.times = [0.0]
+        for k in range(1, len(currents)):
+            self.times.append(self.times[-1] + abs(currents[k] - currents[k - 1]) / self.rate)
+
+    @property
+    def duration(self) -> float:
+        return self.times[-1]
+
+    def segment(self, t: float) -> int:
+        """
+        時刻tに動いている区間の番号 区間kは currents[k] => currents[k+1]
+        """
+        return max(0, min(len(self.currents) - 2, bisect_left(self.times, t) - 1))
+
+    def at(self, t: float) -> int:
+        """
+        時刻tのISET[mA]
+        """
+        if t >= self.duration:
+            return self.currents[-1]
+        k = self.segment(t)
+        t0, t1 = self.times[k], self.times[k + 1]
+        i0, i1 = self.currents[k], self.currents[k + 1]
+        if t1 <= t0:
+            return i1
+        return int(round(i0 + (i1 - i0) * (t - t0) / (t1 - t0)))
+
+
+class Samples:
+    """
+    測定中の生データ
+    電源側 (t, ISET, IOUT, VOUT, 区間) とガウスメーター側 (t, FIELD, 区間) を別々の配列に溜める
+    """
+
+    def __init__(self):
+        self.power_t = array('d')
+        self.iset = array('d')
+        self.iout = array('d')
+        self.vout = array('d')
+        self.field_t = array('d')
+        self.field = array('d')
+        self.field_segment = array('i')
+
+    def merged(self) -> list:
+        """
+        FIELDの読み取り時刻にIOUT/VOUT/ISETを線形補間して揃える
+
+        --------
+        :return: [(t, ISET[A], IOUT[A], FIELD, VOUT[V], 区間), ...]
+        """
+        records = []
+        power_t = self.power_t
+        if len(power_t) < 2:
+            return records
+        for t, field, segment in zip(self.field_t, self.field, self.field_segment):
+            k = min(max(bisect_left(power_t, t), 1), len(power_t) - 1)
+            t0, t1 = power_t[k - 1], power_t[k]
+            w = min(max((t - t0) / (t1 - t0), 0.0), 1.0) if t1 > t0 else 0.0
+            records.append((t,
+                            self.iset[k - 1] if w < 1.0 else self.iset[k],
+                            self.iout[k - 1] + (self.iout[k] - self.iout[k - 1]) * w,
+                            field,
+                            self.vout[k - 1] + (self.vout[k] - self.vout[k - 1]) * w,
+                            segment))
+        return records
+
+
+def acquire(trajectory: Trajectory, write_interval: float = WRITE_INTERVAL) -> Samples:
+    """
+    ISETを軌道に沿って動かしながら両方のバスを読み続ける
+
+    --------
+    :param trajectory:     ISETの軌道
+    :param write_interval: ISET書き込み間隔[sec]
+    :return: Samples
+
+    Raise
+    -----
+    ControlError : WATCHDOG が止めたとき、または磁界を読めなくなったとき
+    """
+    samples = Samples()
+    done = threading.Event()
+    failure = []  # 読み取りスレッドで起きた例外
+    origin = time.monotonic()
+
+    def gauss_loop():
+        try:
+            while not done.is_set():
+                field = helmcoil.FetchField()
+                t = time.monotonic() - origin
+                samples.field_t.append(t)
+                samples.field.append(field)
+                samples.field_segment.append(trajectory.segment(t))
+        except Exception as e:
+            # 磁界を読めないまま電流だけ動かし続けないよう、掃引側に知らせて止める
+            failure.append(e)
+            done.set()
+
+    sampler = threading.Thread(target=gauss_loop, name="gauss-sampler", daemon=True)
+    sampler.start()
+    try:
+        with helmcoil.WATCHDOG:
+            next_write = 0.0
+            iset = trajectory.at(0.0)
+            while not failure:
+                t = time.monotonic() - origin
+                if t >= next_write:
+                    iset = trajectory.at(t)
+                    helmcoil.SetIsetMA(iset)
+                    next_write += write_interval
+                    if t >= trajectory.duration:
+                        break
+                    continue
+                iout = helmcoil.FetchIout()
+                vout = helmcoil.FetchVout()
+                samples.power_t.append(time.monotonic() - origin)
+                samples.iset.append(iset / 1000)
+                samples.iout.append(iout)
+                samples.vout.append(vout)
+    finally:
+        done.set()
+        sampler.join()
+    if failure:
+        raise helmcoil.ControlError("磁界を読めないので掃引を止めました: {}: {}".format(
+            type(failure[0]).__name__, failure[0]))
+    return samples
+
+
+def bin_records(records: list, grids: list, mesh: float, ifine: int = 0) -> list:
+    """
+    記録を区間ごとに磁界の格子点へまとめる
+
+    --------
+    :param records: Samples.merged() の結果
+    :param grids:   区間ごとの格子点[Oe]のリスト
+    :param mesh:    格子間隔[Oe] 格子点から±mesh/2以内の記録をまとめる
+    :param ifine:   測定中のIFINE値
+    :return: 格子点ごとのStatusList (記録のない格子点は含まない)
+    """
+    half = abs(mesh) / 2
+    bins = [[[] for _ in grid] for grid in grids]
+    for record in records:
+        segment = record[5]
+        grid = grids[segment]
+        if not grid:
+            continue
+        k = min(range(len(grid)), key=lambda n: abs(grid[n] - record[3]))
+        if abs(grid[k] - record[3]) <= half:
+            bins[segment][k].append(record)
+
+    result = []
+    for segment_bins in bins:
+        for members in segment_bins:
+            if not members:
+                continue
+            count = len(members)
+            status = helmcoil.StatusList()
+            status.diff_second = int(sum(r[0] for r in members) / count)
+            status.iset = round(sum(r[1] for r in members) / count, 3)
+            status.iout = round(sum(r[2] for r in members) / count, 4)
+            status.field = math.fsum(r[3] for r in members) / count
+            status.vout = round(sum(r[4] for r in members) / count, 4)
+            status.field_count = count
+            if count > 1:
+                status.field_std = math.sqrt(math.fsum((r[3] - status.field) ** 2 for r in members) / (count - 1))
+            status.ifine = ifine
+            result.append(status)
+    return result
+
+
+def field_grids(check_point: list, mesh: int, start: int = 0) -> list:
+    """
+    区間ごとの格子点 区間kは折り返し点k => k+1 (先頭はstart)
+    """
+    grids = []
+    previous = start
+    for next_field in check_point:
+        step = abs(mesh) if next_field >= previous else -abs(mesh)
+        grids.append(list(range(previous, next_field, step)) + [next_field])
+        previous = next_field
+    return grids
+
+
+def continuous_measure(check_point: list = None, mesh: int = 10, rate: float = 150.0) -> None:
+    """
+    連続掃引で Oe_measure() と同じ磁界範囲を測定する
+
+    --------
+    :param check_point: 折り返し磁界[Oe]
+    :param mesh:        記録する格子間隔[Oe]
+    :param rate:        掃引速度[mA/sec]
+    """
+    if check_point is None:
+        check_point = [100, -100, 100]
+    try:
+        helmcoil.allow_power_output(True)
+    except helmcoil.ControlError:
+        print("[FATAL]バイポーラ電源制御エラー!!")
+        return
+    helmcoil.set_gauss_range(300)
+    helmcoil.ctl_magnetic_field(0)
+
+    trajectory = Trajectory(helmcoil.fields_to_ma([0] + check_point), rate)
+    print("連続掃引 {:.0f} mA/sec 予想時間 {:.0f} 秒".format(trajectory.rate, trajectory.duration))
+
+    basename = helmcoil.get_time_str() + "磁歪連続"
+    memo = helmcoil.input_memo()
+    ifine = helmcoil.FetchIFine()
+    # ヘッダの開始時刻を掃引の開始にするため、結果のファイルは掃引前に開いておく
+    with helmcoil.open_session(basename) as session:
+        start_time = session.write_header(memo)
+        try:
+            samples = acquire(trajectory)
+        except helmcoil.ControlError as e:
+            print(e.message)
+            # WATCHDOG が止めた場合は既に0になっている
+            helmcoil.ctl_iout_ma(0, 200, False)
+            return
+        records = samples.merged()
+        statuses = bin_records(records, field_grids(check_point, mesh), mesh, ifine)
+        for status in statuses:
+            session.add_status(status)
+    with helmcoil.CsvSession(basename + "_raw.csv") as raw:
+        raw.writerow(["開始時刻", start_time.strftime('%Y-%m-%d_%H-%M-%S')])
+        raw.writerow(["経過時間[sec]", "設定電流:ISET[A]", "出力電流:IOUT[A]", "磁界:H[Gauss]", "出力電圧:VOUT[V]", "区間"])
+        for record in records:
+            raw.writerow((round(record[0], 4), record[1], round(record[2], 4), record[3], round(record[4], 4), record[5]))
+
+    helmcoil.return_to_zero(check_point[-1])
+    print("{} 点を {} 個の格子点にまとめました".format(len(records), len(statuses)))
+    print("Done")
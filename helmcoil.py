@@ -1,17 +1,34 @@
 # -*- coding: utf-8 -*-
 import csv
 import datetime
+import json
+import os
+import math
 import sys
+import threading
 import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
-import visa
+import calibration
+import connection
+import planner
+import protocol
+import runfile
+import tracing
 
 DEBUG = True
 
+GAUSS_ADDRESS = "ASRL3::INSTR"
+POWER_ADDRESS = "GPIB0::4::INSTR"
+
+# 機器は最初の問い合わせで開く (connection.py)
 if not DEBUG:
-    rm = visa.ResourceManager()
-    gauss = rm.open_resource("ASRL3::INSTR")
-    power = rm.open_resource("GPIB0::4::INSTR")
+    gauss = connection.Connection("gauss", GAUSS_ADDRESS, "*IDN?")
+    power = connection.Connection("power", POWER_ADDRESS, "IDN?")
+else:
+    # 実機の代わりにシミュレータを使う
+    gauss, power = connection.simulated_rig()
 
 
 class ControlError(Exception):
@@ -28,22 +45,62 @@ class StatusList:
     iset = 0.0
     iout = 0.0
     field = 0.0
+    field_std = 0.0
+    field_count = 1
     vout = 0.0
     ifine = 0
     loadtime = datetime.datetime
     diff_second = 0
+    settle_second = 0.0
+    acquired = None  # 項目名 => 取得完了時刻 time.monotonic()
 
     def __str__(self):
-        return "{:03} sec ISET= {:+.3f} IOUT= {:+.3f} Field= {:+.1f}\tVOUT= {:+.3f} IFINE= {:+04}".format(
+        field = "{:+.1f}".format(self.field)
+        if self.field_count > 1:
+            field += "±{:.2f}(n={})".format(self.field_std, self.field_count)
+        return "{:03} sec ISET= {:+.3f} IOUT= {:+.3f} Field= {}\tVOUT= {:+.3f} IFINE= {:+04} settle= {:.2f}".format(
             self.diff_second, self.iset, self.iout,
-            self.field, self.vout, self.ifine)
+            field, self.vout, self.ifine, self.settle_second)
 
     def set_origine_time(self, start_time: datetime.datetime):
         self.loadtime = datetime.datetime.now()
         self.diff_second = (self.loadtime - start_time).seconds
 
     def out_tuple(self) -> tuple:
-        return self.diff_second, self.iset, self.iout, self.field, self.vout, self.ifine
+        return (self.diff_second, self.iset, self.iout, round(self.field, 4), self.vout, self.ifine,
+                round(self.settle_second, 3), round(self.field_std, 4), self.field_count)
+
+
+class SettleCondition:
+    """
+    出力安定判定の条件
+    IOUTが目標値からtolerance_ma以内かつ変化率がslope_ma以下になったら安定とみなす
+    field_slope を指定した場合は磁界の変化率も判定に加える
+    timeout 秒経っても安定しなければ打ち切る
+    """
+
+    def __init__(self, tolerance_ma: float = 10, slope_ma: float = 50, field_slope: float = None,
+                 timeout: float = 1.0, poll: float = 0.02):
+        """
+        --------
+        :param tolerance_ma:  目標電流との許容差[mA]
+        :param slope_ma:      許容する電流変化率[mA/sec] Noneで判定しない
+        :param field_slope:   許容する磁界変化率[Oe/sec] Noneで判定しない
+        :param timeout:       最大待ち時間[sec]
+        :param poll:          問い合わせ間隔の最小値[sec]
+        """
+        self.tolerance_ma = tolerance_ma
+        self.slope_ma = slope_ma
+        self.field_slope = field_slope
+        self.timeout = timeout
+        self.poll = poll
+
+
+# ランプ途中の各ステップ 到達さえすれば次に進む 従来の固定待ち0.1secを上限とする
+RAMP_SETTLE = SettleCondition(tolerance_ma=20, slope_ma=None, timeout=0.1, poll=0.0)
+# 測定点 従来の固定待ち(ISET後0.1sec+測定前0.3~1sec)を上限とする
+POINT_SETTLE = SettleCondition(tolerance_ma=10, slope_ma=50, timeout=1.0)
+POINT_FIELD_SETTLE = SettleCondition(tolerance_ma=10, slope_ma=50, field_slope=2.0, timeout=1.1)
 
 
 def get_time_str() -> str:
@@ -56,6 +113,125 @@ def get_time_str() -> str:
     return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+class ShadowRegister:
+    """
+    機器の設定値(OUT, ISET, IFINE, RANGE)の写し
+    書き込んだ値を覚えておき、問い合わせの代わりに返す
+    verify_every回使うかverify_interval秒経つと実際に問い合わせて写しを確かめる
+    """
+
+    def __init__(self, verify_every: int = 50, verify_interval: float = 30.0):
+        """
+        --------
+        :param verify_every:    この回数写しを返したら実機に問い合わせる
+        :param verify_interval: 最後に確かめてからこの秒数経ったら実機に問い合わせる
+        """
+        self.verify_every = verify_every
+        self.verify_interval = verify_interval
+        self.enabled = True
+        self._values = {}  # protocol.Command => [値, 確認時刻, 写しを返した回数]
+        self.saved = 0
+        self.verified = 0
+        self.mismatch = 0
+
+    def store(self, command: protocol.Command, value) -> None:
+        self._values[command] = [value, time.monotonic(), 0]
+
+    def has(self, command: protocol.Command) -> bool:
+        return self.enabled and command in self._values
+
+    def invalidate(self, instrument: str = None) -> None:
+        """
+        写しを捨てる
+
+        --------
+        :param instrument: "power"/"gauss" の片方だけ捨てる場合に指定
+        """
+        if instrument is None:
+            self._values.clear()
+            return
+        for command in [c for c in self._values if c.instrument == instrument]:
+            del self._values[command]
+
+    def fetch(self, resource, command: protocol.Command, fresh: bool = False):
+        """
+        写しがあればそれを返し、なければ問い合わせる
+
+        --------
+        :param resource: 問い合わせ先
+        :param command:  問い合わせコマンド
+        :param fresh:    写しを使わず必ず問い合わせるか
+        """
+        entry = self._values.get(command)
+        if self.enabled and not fresh and entry is not None:
+            if entry[2] < self.verify_every and time.monotonic() - entry[1] < self.verify_interval:
+                entry[2] += 1
+                self.saved += 1
+                return entry[0]
+        value = protocol.query(resource, command)
+        if entry is not None:
+            self.verified += 1
+            if value != entry[0]:
+                self.mismatch += 1
+                print("[WARN] {} shadow={} actual={}".format(command.header, entry[0], value))
+        self.store(command, value)
+        return value
+
+    def report(self) -> str:
+        return "shadow register: saved {} queries, verified {} ({} mismatch)".format(
+            self.saved, self.verified, self.mismatch)
+
+
+SHADOW = ShadowRegister()
+
+
+class StatusCache:
+    """
+    loadStatus() の各項目の最新値と取得時刻
+    Fetch*() で読んだ値は全てここに入り、loadStatus(max_age=...) は許す古さ以内の値を問い合わせずに使う
+    掃引中に監視や記録のために読んだ値を、表示などの鮮度を問わない読み出しで使い回せる
+    """
+    FIELDS = ("iout", "iset", "vout", "ifine", "field")
+
+    def __init__(self, max_age: float = 0.5):
+        """
+        --------
+        :param max_age: status コマンドなどで使う既定の許容する古さ[sec]
+        """
+        self.max_age = max_age
+        self.enabled = True
+        self._values = {}  # 項目名 => (値, 取得時刻 time.monotonic())
+        self.hits = dict.fromkeys(self.FIELDS, 0)
+        self.misses = dict.fromkeys(self.FIELDS, 0)
+
+    def store(self, name: str, value, acquired: float = None) -> None:
+        self._values[name] = (value, time.monotonic() if acquired is None else acquired)
+
+    def lookup(self, name: str, max_age: float):
+        """
+        --------
+        :return: max_age 秒以内に取得した (値, 取得時刻) なければNone
+        """
+        entry = self._values.get(name)
+        if self.enabled and entry is not None and max_age > 0 and time.monotonic() - entry[1] <= max_age:
+            self.hits[name] += 1
+            return entry
+        self.misses[name] += 1
+        return None
+
+    def invalidate(self) -> None:
+        self._values.clear()
+
+    def report(self) -> str:
+        return "status cache: " + " ".join("{}={}/{}".format(name, self.hits[name], self.hits[name] + self.misses[name])
+                                           for name in self.FIELDS) + " (hit/lookup)"
+
+
+STATUS_CACHE = StatusCache()
+# status / savestatus コマンドで許す古さ 磁界は常に読み直し、IFINEは書き込まない限り変わらない
+STATUS_AGES = {"field": 0.0, "ifine": 5.0}
+
+
 def FetchIout() -> float:
     """
     現在の出力電流を取得する
@@ -69,9 +245,9 @@ def FetchIout() -> float:
     :rtype: float
     :return: 0.012
     """
-    iout = power.query("IOUT?")
-    current = float(iout.translate(str.maketrans('', '', 'IOUT A\r\n')))
-    return current
+    value = protocol.query(power, protocol.IOUT)
+    STATUS_CACHE.store("iout", value)
+    return value
 
 
 def FetchVout() -> float:
@@ -88,9 +264,9 @@ def FetchVout() -> float:
     :rtype: float
     :return: 0.015
     """
-    vout = power.query("VOUT?")
-    voltage = float(vout.translate(str.maketrans('', '', 'VOUT V\r\n')))
-    return voltage
+    value = protocol.query(power, protocol.VOUT)
+    STATUS_CACHE.store("vout", value)
+    return value
 
 
 def FetchIset() -> float:
@@ -107,8 +283,9 @@ def FetchIset() -> float:
     :rtype: float
     :return: 0.010
     """
-    vout = power.query("ISET?")
-    return float(vout.translate(str.maketrans('', '', 'ISET A\r\n')))
+    value = SHADOW.fetch(power, protocol.ISET)
+    STATUS_CACHE.store("iset", value)
+    return value
 
 
 def FetchVset() -> float:
@@ -125,8 +302,7 @@ def FetchVset() -> float:
     :rtype: float
     :return: 1.234
     """
-    vout = power.query("VSET?")
-    return float(vout.translate(str.maketrans('', '', 'VSET V\r\n')))
+    return protocol.query(power, protocol.VSET)
 
 
 def SetIset(i: float):
@@ -142,25 +318,26 @@ def SetIset(i: float):
     :param i: 設定電圧[A]
     :return:
     """
-    power.write("ISET {0:.3f}".format(i))
+    WATCHDOG.check()
+    protocol.write(power, protocol.SET_ISET, i)
+    SHADOW.store(protocol.ISET, round(i, 3))
+    STATUS_CACHE.store("iset", round(i, 3))
 
 
 def set_gauss_range(gauss_range: int = 0) -> None:
-    if gauss_range == 0:
-        gauss.write("RANGE 0")
     abs_range = abs(gauss_range)
-    if abs_range >= 30:
-        gauss.write("RANGE 3")
-        return
+    if abs_range >= 3000:
+        range_no = 1
     elif abs_range >= 300:
-        gauss.write("RANGE 2")
-        return
-    elif abs_range >= 3000:
-        gauss.write("RANGE 1")
-        return
+        range_no = 2
+    elif abs_range >= 30:
+        range_no = 3
     else:
-        gauss.write("RANGE 0")
+        range_no = 0
+    if SHADOW.has(protocol.RANGE) and SHADOW.fetch(gauss, protocol.RANGE) == range_no:
         return
+    protocol.write(gauss, protocol.SET_RANGE, range_no)
+    SHADOW.store(protocol.RANGE, range_no)
 
 
 def FetchIFine() -> int:
@@ -168,17 +345,18 @@ def FetchIFine() -> int:
     現在の電流ファイン値を取得する
     単位:int8(-128~+127)
 
-    Notes?not real answer
+    Notes
     -----
     Query   : "IFINE?"
-    Answer  : 'IFINE 1V\r\n'
+    Answer  : 'IFINE    1\r\n'
 
     --------
     :rtype: int
     :return: 1
     """
-    ifine = power.query("IFINE?")
-    return int(ifine.translate(str.maketrans('', '', 'IFINE\r\n')))
+    value = SHADOW.fetch(power, protocol.IFINE)
+    STATUS_CACHE.store("ifine", value)
+    return value
 
 
 def SetIFine(fine: int):
@@ -198,7 +376,9 @@ def SetIFine(fine: int):
         fine = -128
     elif fine > 127:
         fine = 127
-    power.write("IFINE " + str(fine))
+    protocol.write(power, protocol.SET_IFINE, fine)
+    SHADOW.store(protocol.IFINE, fine)
+    STATUS_CACHE.store("ifine", fine)
 
 
 def allow_power_output(operation: bool) -> None:
@@ -222,13 +402,11 @@ def allow_power_output(operation: bool) -> None:
             SetIset(0)
         else:
             ctl_iout_ma(0)
-    time.sleep(0.1)
-    if operation:
-        power.write("OUT 1")
-    else:
-        power.write("OUT 0")
-    time.sleep(0.1)
-    if CanOutput() == operation:
+    tracing.sleep(0.1)
+    protocol.write(power, protocol.SET_OUT, 1 if operation else 0)
+    SHADOW.store(protocol.OUT, operation)
+    tracing.sleep(0.1)
+    if CanOutput(fresh=True) == operation:
         return
     raise ControlError("バイポーラ電源出力制御失敗")
 
@@ -256,7 +434,7 @@ def A_to_mA(current: float) -> int:
     :param current: 電流[A] 1.234
     :return: 電流[A] 1234
     """
-    return int(current * 1000)
+    return int(round(current * 1000))
 
 
 def FetchField() -> float:
@@ -272,28 +450,144 @@ def FetchField() -> float:
     --------
     :return: 102.3
     """
-    value = gauss.query("FIELD?")
-    return float(value.translate(str.maketrans('', '', ' \r\n')))
+    value = protocol.query(gauss, protocol.FIELD)
+    STATUS_CACHE.store("field", (value, 0.0, 1))
+    return value
+
+
+class FieldRing:
+    """
+    FIELD?の読み取り値を溜める固定長のリングバッファ
+    """
+
+    def __init__(self, size: int = 1024):
+        self.buffer = array('d', bytes(8 * size))
+        self.position = 0
+
+    def fill(self, count: int) -> None:
+        """
+        ガウスメーターからcount回続けて読み取る
+        """
+        count = min(count, len(self.buffer))
+        protocol.query_into(gauss, protocol.FIELD, self.buffer, self.position, count)
+        self.position = (self.position + count) % len(self.buffer)
+
+    def stats(self, count: int) -> tuple:
+        """
+        直近count個の平均と標準偏差
+
+        --------
+        :return: (平均, 標準偏差, 個数)
+        """
+        size = len(self.buffer)
+        count = min(count, size)
+        values = [self.buffer[(self.position - k - 1) % size] for k in range(count)]
+        mean = math.fsum(values) / count
+        if count < 2:
+            return mean, 0.0, count
+        std = math.sqrt(math.fsum((v - mean) ** 2 for v in values) / (count - 1))
+        return mean, std, count
+
+
+# 記録点ごとに磁界を何回読んで平均するか
+FIELD_SAMPLES = 1
+FIELD_RING = FieldRing()
+
+
+def FetchFieldStats(samples: int = None) -> tuple:
+    """
+    磁界をsamples回続けて読み取り、平均と標準偏差を返す
+
+    --------
+    :param samples: 読み取り回数 Noneの場合はFIELD_SAMPLES
+    :return: (平均, 標準偏差, 個数)
+    """
+    if samples is None:
+        samples = FIELD_SAMPLES
+    if samples <= 1:
+        return FetchField(), 0.0, 1
+    FIELD_RING.fill(samples)
+    stats = FIELD_RING.stats(samples)
+    STATUS_CACHE.store("field", stats)
+    return stats
+
+
+_STRIP_BLANK = str.maketrans('', '', ' \r\n')
 
 
 def ReadField() -> str:
-    field_str = gauss.query("FIELD?") + gauss.query("FIELDM?") + gauss.query("UNIT?")
-    return field_str.translate(str.maketrans('', '', ' \r\n'))
+    field_str = "".join(protocol.query_raw(gauss, command) for command in (protocol.FIELD, protocol.FIELDM, protocol.UNIT))
+    return field_str.translate(_STRIP_BLANK)
+
+
+# ガウスメーター(シリアル)とバイポーラ電源(GPIB)はバスが別なので並行して問い合わせる
+FLAG_CONCURRENT_STATUS = True
+_gauss_bus = None
 
 
-def loadStatus() -> StatusList:
+def _gauss_executor() -> ThreadPoolExecutor:
+    """
+    ガウスメーター問い合わせ用のスレッドを返す
+    同じバスへの問い合わせが重ならないよう1本だけ作る
+    """
+    global _gauss_bus
+    if _gauss_bus is None:
+        _gauss_bus = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gauss-bus")
+    return _gauss_bus
+
+
+def _timed_fetch(fetch) -> tuple:
+    value = fetch()
+    return value, time.monotonic()
+
+
+def loadStatus(concurrent: bool = None, max_age: float = None, ages: dict = None) -> StatusList:
     """
     各ステータスをまとめて取得する
+    concurrentが真のときはFIELD?を別スレッドで問い合わせ、電源側の問い合わせと重ねる
+    max_age または ages を指定すると、その古さ以内に読んだ項目は STATUS_CACHE の値を使う
+    各項目の取得完了時刻はacquiredに入る
 
     --------
+    :param concurrent: 並行取得するか Noneの場合はFLAG_CONCURRENT_STATUSに従う
+    :param max_age:    全項目で許す古さ[sec] Noneの場合は全て問い合わせる
+    :param ages:       項目ごとに許す古さ[sec] {"field": 0.0, "ifine": 5.0}
     :return: StatusList
     """
+    if concurrent is None:
+        concurrent = FLAG_CONCURRENT_STATUS
     result = StatusList()
-    result.iout = FetchIout()
-    result.iset = FetchIset()
-    result.vout = FetchVout()
-    result.field = FetchField()
-    result.ifine = FetchIFine()
+    acquired = {}
+    cached = {}
+    if max_age is not None or ages:
+        ages = ages or {}
+        for name in StatusCache.FIELDS:
+            entry = STATUS_CACHE.lookup(name, ages.get(name, max_age or 0.0))
+            if entry is not None:
+                cached[name] = entry
+
+    def fetch(name: str, fetcher):
+        if name in cached:
+            value, acquired[name] = cached[name]
+        else:
+            value, acquired[name] = _timed_fetch(fetcher)
+        return value
+
+    field_future = None
+    if concurrent and "field" not in cached:
+        field_future = _gauss_executor().submit(_timed_fetch, FetchFieldStats)
+
+    result.iout = fetch("iout", FetchIout)
+    result.iset = fetch("iset", FetchIset)
+    result.vout = fetch("vout", FetchVout)
+    if field_future is None:
+        field = fetch("field", FetchFieldStats)
+    result.ifine = fetch("ifine", FetchIFine)
+    if field_future is not None:
+        field, acquired["field"] = field_future.result()
+    result.field, result.field_std, result.field_count = field
+
+    result.acquired = acquired
     return result
 
 
@@ -316,21 +610,22 @@ def addSaveStatus(filename: str, status: StatusList) -> None:
 
 def usWriteGauss(command: str) -> None:
     gauss.write(command)
+    SHADOW.invalidate("gauss")
 
 
 def usWritePower(command: str) -> None:
     power.write(command)
+    SHADOW.invalidate("power")
 
 
-def CanOutput() -> bool:
+def CanOutput(fresh: bool = False) -> bool:
     """
     電源出力が可能かを返す
     --------
+    :param fresh: 写しを使わず必ず問い合わせるか
     :return:
     """
-    if power.query("OUT?") == 'OUT 001\r\n':
-        return True
-    return False
+    return SHADOW.fetch(power, protocol.OUT, fresh)
 
 
 def auto_i_fine_binary(target: int, fine: int, ttl: int) -> int:
@@ -345,7 +640,7 @@ def auto_i_fine_binary(target: int, fine: int, ttl: int) -> int:
     :return:    最終FINE値
     """
     SetIFine(fine)
-    time.sleep(0.4)
+    tracing.sleep(0.4)
     current = A_to_mA(FetchIout())
     diffi = current - target
     print(diffi, "TTL:", ttl, "fine", fine)
@@ -363,17 +658,21 @@ def auto_i_fine_binary(target: int, fine: int, ttl: int) -> int:
         return auto_i_fine_binary(target, fine - 2 ** ttl, ttl)
 
 
-def auto_ifine_offset(target) -> int:
+def auto_ifine_offset(target, start: int = None) -> int:
     """
+    IFINEを1ずつ動かしてIOUTを目標電流に合わせる
 
-    :return:
+    --------
+    :param target: 目標電流[mA]
+    :param start:  探索を始めるFINE値 Noneの場合は既定値-25
+    :return: 最終FINE値
     """
     TTL = 20
-    FINEBASECONST = -25
+    FINEBASECONST = -25 if start is None else start
     SetIFine(FINEBASECONST)
-    time.sleep(0.3)
+    tracing.sleep(0.3)
     current = A_to_mA(FetchIout())
-    diff_current = target - current
+    diff_current = current - target
     if diff_current == 0:
         return FINEBASECONST
     fine = FINEBASECONST
@@ -385,80 +684,881 @@ def auto_ifine_offset(target) -> int:
         else:
             fine += 1
         SetIFine(fine)
-        time.sleep(0.2)
+        tracing.sleep(0.2)
         diff_current = A_to_mA(FetchIout()) - target
         TTL -= 1
     return fine
 
 
-def ctl_iout_ma(target: int, step: int = 100, auto_fine: bool = False) -> None:
+class SettleTracker:
+    """
+    安定判定
+    問い合わせ結果を1回ずつupdate()に渡し、安定したかtimeoutに達したらTrueを返す
+    """
+
+    def __init__(self, target: int, condition: SettleCondition):
+        self.target = target
+        self.condition = condition
+        self.start = time.monotonic()
+        self.elapsed = 0.0
+        self.timed_out = False
+        self._last = None
+
+    def update(self, now: float, current: float, field: float = 0.0) -> bool:
+        """
+        --------
+        :param now:     問い合わせ時刻 time.monotonic()
+        :param current: IOUT[mA]
+        :param field:   磁界 判定に使わない場合は0
+        :return: 待ち終わったか
+        """
+        condition = self.condition
+        self.elapsed = now - self.start
+        settled = abs(current - self.target) <= condition.tolerance_ma
+        if settled and (condition.slope_ma is not None or condition.field_slope is not None):
+            if self._last is None:
+                settled = False
+            else:
+                last_time, last_current, last_field = self._last
+                dt = max(now - last_time, 1e-6)
+                if condition.slope_ma is not None and abs(current - last_current) / dt > condition.slope_ma:
+                    settled = False
+                if condition.field_slope is not None and abs(field - last_field) / dt > condition.field_slope:
+                    settled = False
+        if settled:
+            return True
+        if self.elapsed >= condition.timeout:
+            print("[WARN] settle timeout target={}mA IOUT={:.0f}mA".format(self.target, current))
+            self.timed_out = True
+            return True
+        self._last = (now, current, field)
+        return False
+
+
+def wait_settle(target: int, condition: SettleCondition = POINT_SETTLE) -> float:
+    """
+    出力が安定するまでIOUT(と必要ならFIELD)を問い合わせ続ける
+    timeoutに達した場合は警告を出して打ち切る
+
+    --------
+    :param target:    目標電流[mA]
+    :param condition: 安定判定の条件
+    :return: 安定までにかかった時間[sec]
+    """
+    tracker = SettleTracker(target, condition)
+    with tracing.span("settle", None, target):
+        while True:
+            WATCHDOG.check()
+            now = time.monotonic()
+            current = FetchIout() * 1000
+            field = FetchField() if condition.field_slope is not None else 0.0
+            if tracker.update(now, current, field):
+                return tracker.elapsed
+            wait = condition.poll - (time.monotonic() - now)
+            if wait > 0:
+                tracing.sleep(wait)
+
+
+# 適応ランプ
+FLAG_ADAPTIVE_RAMP = True
+PBX_VMAX = 40.0        # PBX 40-10 のコンプライアンス電圧[V]
+RAMP_HEADROOM = 0.8    # ランプ中に許すVOUTの上限 PBX_VMAXに対する割合
+RAMP_MAX_STEP = 2000   # 適応ランプの1ステップの上限[mA]
+
+
+class CoilEstimator:
+    """
+    ランプ中のIOUT/VOUTからコイルの抵抗R[Ω]とインダクタンスL[H]、電源の電流ループの時定数tau[sec]を推定する
+    R, L は VOUT = R*IOUT + L*dIOUT/dt として忘却係数付きの最小二乗で解く
+    tau はステップ中の 残差/(VOUT-R*IOUT) = tau/L から求める 残差も電圧も同じ exp(-t/tau) で減るので
+    問い合わせのタイミングによらず、問い合わせ間隔より速いVOUTの山も見積もれる
+    """
+
+    def __init__(self, forgetting: float = 0.98):
+        self.forgetting = forgetting
+        self.resistance = None
+        self.inductance = None
+        self.tau = None
+        self._sums = [0.0] * 5  # ΣI^2, ΣI*D, ΣD^2, ΣI*V, ΣD*V
+
+    @property
+    def ready(self) -> bool:
+        return self.resistance is not None and self.inductance is not None and self.tau is not None
+
+    def reset(self) -> None:
+        self.__init__(self.forgetting)
+
+    def observe(self, current: float, didt: float, vout: float) -> None:
+        """
+        --------
+        :param current: IOUT[A]
+        :param didt:    IOUTの変化率[A/sec]
+        :param vout:    VOUT[V]
+        """
+        f = self.forgetting
+        s = self._sums
+        for k, value in enumerate((current * current, current * didt, didt * didt, current * vout, didt * vout)):
+            s[k] = s[k] * f + value
+        det = s[0] * s[2] - s[1] * s[1]
+        if det <= 1e-3 * s[0] * s[2]:
+            return  # IとdI/dtが同じように動いていて分離できない
+        resistance = (s[3] * s[2] - s[1] * s[4]) / det
+        inductance = (s[0] * s[4] - s[1] * s[3]) / det
+        if resistance > 0 and inductance > 0:
+            self.resistance, self.inductance = resistance, inductance
+
+    def observe_step(self, remaining: float, vout: float, current: float) -> None:
+        """
+        --------
+        :param remaining: VOUT読み取り時点の目標までの残差[A]
+        :param vout:      VOUT[V]
+        :param current:   VOUT読み取り時点のIOUT[A]
+        """
+        if self.resistance is None or self.inductance is None:
+            return
+        excess = vout - self.resistance * current
+        if abs(excess) < 0.2 or excess * remaining <= 0:
+            return
+        tau = self.inductance * remaining / excess
+        # 大きくなる(安全側の)向きにはすぐ追従する
+        self.tau = tau if self.tau is None or tau > self.tau else 0.8 * self.tau + 0.2 * tau
+
+    def max_step(self, current: float, direction: int, vlimit: float) -> float:
+        """
+        VOUTがvlimitを超えない最大のステップ幅[A]
+        幅mのステップ直後の電圧を R*(I + direction*m) + direction*L*m/tau とみなして解く
+        0に向かう向きは R*I が逆起電力を打ち消すので大きく動ける
+
+        --------
+        :param current:   現在の電流[A]
+        :param direction: 1:増やす -1:減らす
+        :param vlimit:    VOUTの上限[V]
+        """
+        return max(0.0, (vlimit - direction * self.resistance * current) /
+                   (self.inductance / self.tau + self.resistance))
+
+
+COIL = CoilEstimator()
+
+
+def _ramp_follow(target: int) -> float:
+    """
+    ISET書き込み後、IOUTが RAMP_SETTLE の許容差に入るまでIOUTとVOUTを交互に読み、COILの推定を更新する
+    VOUTは前後2回のIOUTの間で読むので、読み取り時点の残差は前後の残差の幾何平均とする
+
+    --------
+    :param target:  書き込んだ電流[mA]
+    :return: 観測したVOUTの絶対値の最大[V]
+    """
+    timeout = RAMP_SETTLE.timeout if COIL.tau is None else max(RAMP_SETTLE.timeout, 5 * COIL.tau)
+    peak = 0.0
+    with tracing.span("settle", None, target):
+        start = t0 = time.monotonic()
+        i0 = FetchIout()
+        while abs(i0 * 1000 - target) > RAMP_SETTLE.tolerance_ma and t0 - start < timeout:
+            WATCHDOG.check()
+            vout = FetchVout()
+            peak = max(peak, abs(vout))
+            t1 = time.monotonic()
+            i1 = FetchIout()
+            if t1 > t0:
+                COIL.observe((i0 + i1) / 2, (i1 - i0) / (t1 - t0), vout)
+            e0, e1 = target / 1000 - i0, target / 1000 - i1
+            if e0 * e1 > 0:
+                COIL.observe_step(math.copysign(math.sqrt(e0 * e1), e0), vout, (i0 + i1) / 2)
+            t0, i0 = t1, i1
+    return peak
+
+
+def ramp_iset_ma(current: int, target: int, step: int = 100) -> None:
+    """
+    ISETを current から target の手前まで段階的に動かす target自体は書き込まない
+    COILの推定が済んでいれば、VOUTが PBX_VMAX*RAMP_HEADROOM を超えない最大の幅(RAMP_MAX_STEPまで)で動かす
+    推定が済むまでと、VOUTが上限を超えた後はstep刻みで動かす
+
+    --------
+    :param current: 現在の設定電流[mA]
+    :param target:  目標電流[mA]
+    :param step:    従来の固定ランプ幅[mA] 300を超える場合は300 適応幅の最小値にもなる
+    """
+    step = min(abs(step) or 100, 300)
+    direction = 1 if target > current else -1
+    vlimit = PBX_VMAX * RAMP_HEADROOM
+    adaptive = True
+    with tracing.span("ramp", None, target):
+        while True:
+            width = step
+            if adaptive and COIL.ready:
+                width = max(step, min(RAMP_MAX_STEP, int(COIL.max_step(mA_to_a(current), direction, vlimit) * 1000)))
+            next_current = current + direction * width
+            if (target - next_current) * direction <= 0:
+                return
+            SetIsetMA(next_current)
+            peak = _ramp_follow(next_current)
+            if adaptive and peak > vlimit:
+                adaptive = False
+                print("[WARN]ランプ中のVOUTが{:.1f}Vを超えたので{}mA刻みに戻します".format(vlimit, step))
+            current = next_current
+
+
+# 安全監視
+FLAG_WATCHDOG = True
+WATCHDOG_LOG = "watchdog.log"
+
+
+class SafetyWatchdog:
+    """
+    掃引中に別スレッドで一定間隔でIOUT/VOUTを読み、異常があれば掃引を止めて電流を0まで下げる
+
+    異常とみなす条件
+        |IOUT| > current_limit または |VOUT| > voltage_limit
+        出力ON中にISETとIOUTの差が divergence_ma を超えた状態が divergence_second 続く
+        stall_second の間 電源への問い合わせが返ってこない、または通信エラー
+    異常を検出すると tripped に内容を入れ、別スレッドで電流を0まで下げる。
+    tripped の間 SetIset() と安定待ちは ControlError を投げるので、掃引は次の書き込みか安定待ちで止まる。
+    検出までの時間は period + 問い合わせ1回分、バスが止まった場合は stall_second + period 以内。
+
+    --------
+    with WATCHDOG:
+        run_plan(...)
+    """
+
+    def __init__(self, period: float = 0.2, current_limit: float = 10.0, voltage_limit: float = PBX_VMAX * 0.95,
+                 divergence_ma: float = 200, divergence_second: float = 1.0, stall_second: float = 3.0):
+        """
+        --------
+        :param period:            監視間隔[sec]
+        :param current_limit:     IOUTの上限[A]
+        :param voltage_limit:     VOUTの上限[V]
+        :param divergence_ma:     ISETとIOUTの差の上限[mA]
+        :param divergence_second: 差が上限を超えたままでいられる時間[sec]
+        :param stall_second:      問い合わせが返ってこないとみなす時間[sec]
+        """
+        self.period = period
+        self.current_limit = current_limit
+        self.voltage_limit = voltage_limit
+        self.divergence_ma = divergence_ma
+        self.divergence_second = divergence_second
+        self.stall_second = stall_second
+        self.tripped = None  # 異常の内容 正常時はNone
+        self.events = 0
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._stop = threading.Event()
+        self._threads = []
+        self._ramp_thread = None
+        self._last_ok = 0.0
+        self._diverged_since = None
+
+    def check(self) -> None:
+        """
+        Raise
+        -----
+        ControlError : 異常を検出していて掃引を止めるべきとき
+        """
+        if self.tripped is not None:
+            raise ControlError("[SAFETY]" + self.tripped)
+
+    def stop(self, reason: str = "中断") -> None:
+        """
+        異常と同じ扱いで掃引を止め、電流を0まで下げる 監視していないときは次の SetIset() で止まる
+        """
+        self._trip(reason)
+
+    def __enter__(self) -> "SafetyWatchdog":
+        with self._lock:
+            self._depth += 1
+            if self._depth > 1 or not FLAG_WATCHDOG:
+                return self
+            self.tripped = None
+            self._stop.clear()
+            self._last_ok = time.monotonic()
+            self._diverged_since = None
+            self._threads = [threading.Thread(target=self._sample_loop, name="watchdog-sampler", daemon=True),
+                             threading.Thread(target=self._stall_loop, name="watchdog-stall", daemon=True)]
+            for thread in self._threads:
+                thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        with self._lock:
+            self._depth -= 1
+            if self._depth > 0:
+                return
+            self._stop.set()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(self.stall_second + self.period)
+        if self.tripped is None:
+            return
+        # 電流を下げ終わるまで次の操作を受け付けない
+        if self._ramp_thread is not None:
+            self._ramp_thread.join()
+        reason, self.tripped = self.tripped, None
+        if exc_type is None:
+            raise ControlError("[SAFETY]" + reason)
+
+    def _sample_loop(self) -> None:
+        while not self._stop.is_set() and self.tripped is None:
+            start = time.monotonic()
+            try:
+                iout = FetchIout()
+                vout = FetchVout()
+            except (protocol.ProtocolError,) + connection.RETRYABLE as e:
+                self._trip("通信エラー {}".format(e))
+                return
+            self._last_ok = time.monotonic()
+            self._inspect(self._last_ok, iout, vout)
+            self._stop.wait(max(0.0, self.period - (time.monotonic() - start)))
+
+    def _stall_loop(self) -> None:
+        while not self._stop.wait(self.period) and self.tripped is None:
+            if time.monotonic() - self._last_ok > self.stall_second:
+                self._trip("電源の応答が{:.1f}秒以上ありません".format(time.monotonic() - self._last_ok))
+
+    def _inspect(self, now: float, iout: float, vout: float) -> None:
+        if abs(iout) > self.current_limit:
+            self._trip("IOUT {:+.3f}A が上限 {}A を超えました".format(iout, self.current_limit), iout, vout)
+        elif abs(vout) > self.voltage_limit:
+            self._trip("VOUT {:+.3f}V が上限 {}V を超えました".format(vout, self.voltage_limit), iout, vout)
+        elif SHADOW.has(protocol.ISET) and SHADOW.has(protocol.OUT) and SHADOW.fetch(power, protocol.OUT):
+            difference = abs(SHADOW.fetch(power, protocol.ISET) - iout) * 1000
+            if difference <= self.divergence_ma:
+                self._diverged_since = None
+            elif self._diverged_since is None:
+                self._diverged_since = now
+            elif now - self._diverged_since >= self.divergence_second:
+                self._trip("ISETとIOUTの差 {:.0f}mA が{:.1f}秒続きました".format(difference, now - self._diverged_since),
+                           iout, vout)
+
+    def _trip(self, reason: str, iout: float = None, vout: float = None) -> None:
+        with self._lock:
+            if self.tripped is not None:
+                return
+            self.tripped = reason
+            self.events += 1
+        print("[SAFETY]" + reason + " 電流を0まで下げます")
+        self.log(reason, iout, vout)
+        self._ramp_thread = threading.Thread(target=self._ramp_down, name="watchdog-rampdown", daemon=True)
+        self._ramp_thread.start()
+
+    def _ramp_down(self) -> None:
+        """
+        SetIset() を通さずに書き込む 0に向かう向きは R*I が逆起電力を打ち消すので COIL の推定で大きく動ける
+        """
+        vlimit = PBX_VMAX * RAMP_HEADROOM
+        try:
+            current = A_to_mA(FetchIout())
+            while current != 0:
+                sign = 1 if current > 0 else -1
+                width = 300
+                if COIL.ready:
+                    width = max(width, min(RAMP_MAX_STEP, int(COIL.max_step(mA_to_a(current), -sign, vlimit) * 1000)))
+                current = 0 if abs(current) <= width else current - sign * width
+                protocol.write(power, protocol.SET_ISET, mA_to_a(current))
+                SHADOW.store(protocol.ISET, mA_to_a(current))
+                STATUS_CACHE.store("iset", mA_to_a(current))
+                deadline = time.monotonic() + 1.0
+                while abs(FetchIout() * 1000 - current) > RAMP_SETTLE.tolerance_ma and time.monotonic() < deadline:
+                    pass
+            self.log("ramp down done", FetchIout(), FetchVout())
+            print("[SAFETY]電流を0に下げました")
+        except Exception as e:
+            self.log("ramp down failed: {}".format(e))
+            print("[SAFETY]電流を下げられませんでした 電源を確認してください: {}".format(e))
+
+    def log(self, event: str, iout: float = None, vout: float = None) -> None:
+        iset = SHADOW.fetch(power, protocol.ISET) if SHADOW.has(protocol.ISET) else ""
+        try:
+            with open(WATCHDOG_LOG, mode="a", encoding="utf-8") as f:
+                csv.writer(f, lineterminator="\n").writerow([get_time_str(), event, iset,
+                                                            "" if iout is None else iout,
+                                                            "" if vout is None else vout])
+        except OSError as e:
+            print(e)
+
+
+WATCHDOG = SafetyWatchdog()
+
+
+def ctl_iout_ma(target: int, step: int = 100, auto_fine: bool = False,
+                settle: SettleCondition = POINT_SETTLE) -> float:
     """
     安全に電流を設定値にあわせる
-    limitに引っかからないようにstep ごとに徐々に電流を変化させる
-    step>300で強制的に300に安全のため固定
+    limitに引っかからないように徐々に電流を変化させる
+    FLAG_ADAPTIVE_RAMP が偽のときは step ごと(step>300は安全のため300に固定)
+    真のとき(既定)は ramp_iset_ma() で、COILの推定が済めばVOUTが PBX_VMAX*RAMP_HEADROOM を
+    超えない幅(最大 RAMP_MAX_STEP)で動かす 推定前とVOUTが上限を超えた後は step(最大300) ごと
     --------
     :param target:  目標電流[mA]
-    :param step:    変化させる電流幅[mA]
+    :param step:    変化させる電流幅[mA] FLAG_ADAPTIVE_RAMP のときは最小幅
     :param auto_fine: autoFINEを使用するか
+    :param settle:  目標値到達後の安定判定条件
+    :return: 目標値到達後の安定にかかった時間[sec]
     """
     if step == 0:
         step = 100
 
     if auto_fine:
         SetIFine(0)
-        time.sleep(0.2)
-    current = A_to_mA(FetchIout())
+        tracing.sleep(0.2)
+    # 設定電流を覚えていればそこからランプする
+    if SHADOW.has(protocol.ISET):
+        current = A_to_mA(FetchIset())
+    else:
+        current = A_to_mA(FetchIout())
     if target == current:
-        return
+        return 0.0
     if abs(step) > 300:
         step = 300
 
-    if current < target:
-        transit_current = range(current, target, abs(step))  # 経由電流値
-    else:
-        transit_current = range(current, target, abs(step) * -1)
-
-    for mA in transit_current:
-        SetIsetMA(mA)
-        time.sleep(0.1)
-
+    ramp_to(current, target, step)
     SetIsetMA(target)
-    time.sleep(0.1)
+    settle_time = wait_settle(target, settle)
     diff_iout = A_to_mA(FetchIout()) - target
 
     if not auto_fine or abs(diff_iout) <= 1:
+        return settle_time
+
+    tune_ifine(target)
+    return settle_time
+
+
+def ramp_to(current: int, target: int, step: int) -> None:
+    """
+    ISETを current から target の手前まで動かす target自体は書き込まない
+    FLAG_ADAPTIVE_RAMP のときは ramp_iset_ma()、それ以外は step(最大300mA) 刻み
+    """
+    if current == target:
+        return
+    if FLAG_ADAPTIVE_RAMP:
+        ramp_iset_ma(current, target, step)
         return
+    step = min(abs(step) or 100, 300)
+    if current > target:
+        step = -step
+    with tracing.span("ramp", None, target):
+        for mA in range(current + step, target, step):  # 経由電流値
+            SetIsetMA(mA)
+            wait_settle(mA, RAMP_SETTLE)
 
-    auto_ifine_offset(target)
-    return
+
+class IFineTable:
+    """
+    目標電流ごとの収束したIFINE値の表
+    ファイルに保存して次回以降の測定でも使う
+    表にない電流は前後の記録から線形補間する
+    max_age秒より古い記録は使わない
+    """
+
+    def __init__(self, filename: str = "ifine_table.json", max_age: float = 7 * 24 * 3600, max_gap: int = 1000):
+        """
+        --------
+        :param filename: 保存先
+        :param max_age:  記録の有効期限[sec]
+        :param max_gap:  補間に使う前後の記録の最大間隔[mA]
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self.max_gap = max_gap
+        self._entries = None  # 目標電流[mA] => (FINE値, 記録時刻 time.time())
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.filename, encoding="utf-8") as f:
+                    for target, entry in json.load(f).items():
+                        self._entries[int(target)] = (int(entry["fine"]), float(entry["time"]))
+            except (OSError, ValueError, KeyError):
+                pass
+        return self._entries
+
+    def save(self) -> None:
+        entries = {str(target): {"fine": fine, "time": stored} for target, (fine, stored) in sorted(self._load().items())}
+        temp = self.filename + ".tmp"
+        with open(temp, mode="w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(temp, self.filename)
+
+    def store(self, target: int, fine: int) -> None:
+        self._load()[target] = (fine, time.time())
+        self.save()
+
+    def invalidate(self, target: int = None) -> None:
+        """
+        記録を消す
+
+        --------
+        :param target: 消す目標電流[mA] Noneの場合は全て消す
+        """
+        if target is None:
+            self._load().clear()
+        else:
+            self._load().pop(target, None)
+        self.save()
+
+    def lookup(self, target: int):
+        """
+        目標電流に対するFINE値の推定値を返す
+
+        --------
+        :param target: 目標電流[mA]
+        :return: FINE値 推定できなければNone
+        """
+        oldest = time.time() - self.max_age
+        fresh = {t: fine for t, (fine, stored) in self._load().items() if stored >= oldest}
+        if target in fresh:
+            return fresh[target]
+        lower = [t for t in fresh if target - self.max_gap <= t < target]
+        upper = [t for t in fresh if target < t <= target + self.max_gap]
+        if not lower or not upper:
+            return None
+        low, high = max(lower), min(upper)
+        ratio = (target - low) / (high - low)
+        return int(round(fresh[low] + (fresh[high] - fresh[low]) * ratio))
+
+
+IFINE_TABLE = IFineTable()
+FINE_SETTLE = SettleCondition(tolerance_ma=10, slope_ma=20, timeout=0.4)
+
+
+def tune_ifine(target: int) -> int:
+    """
+    IOUTが目標電流に一致するようIFINEを合わせる
+    表に記録があれば1回の設定で確認し、ずれていればそこから探索する
+
+    --------
+    :param target: 目標電流[mA]
+    :return: 最終FINE値
+    """
+    fine = IFINE_TABLE.lookup(target)
+    if fine is not None:
+        SetIFine(fine)
+        wait_settle(target, FINE_SETTLE)
+        if A_to_mA(FetchIout()) == target:
+            IFINE_TABLE.store(target, fine)
+            return fine
+    fine = auto_ifine_offset(target, fine)
+    if A_to_mA(FetchIout()) == target:
+        IFINE_TABLE.store(target, fine)
+    return fine
 
 
 Oe_CURRENT_CONST = 20.960
+Oe_LIMIT = 110
+# 磁界-電流校正表 Noneの場合はOe_CURRENT_CONSTによる直線で換算する
+FIELD_CALIBRATION = None
+_last_field = 0
 
 
-def ctl_magnetic_field(target):
-    global Oe_CURRENT_CONST
-    if not target <= 110:
-        target = 100
-    gauss_ma_current_const = Oe_CURRENT_CONST / 1000
-    target_current = int(target / gauss_ma_current_const)
-    ctl_iout_ma(target_current, 150, False)
-    return
+def set_last_field(field: int) -> None:
+    """
+    掃引で到達した磁界を記録する 次の fields_to_ma() の向き(UP/DOWN)の判定に使う
+    run_plan() などISETを直接動かす掃引の後に呼ぶ
 
+    --------
+    :param field: 到達した磁界[Oe]
+    """
+    global _last_field
+    _last_field = field
 
-def gen_csv_header(filename) -> datetime:
+
+def load_field_calibration(filename: str) -> None:
+    """
+    磁界-電流校正表を読み込む
+
+    Raise
+    -----
+    ControlError : 読み込めないとき
+    """
+    global FIELD_CALIBRATION
+    try:
+        FIELD_CALIBRATION = calibration.FieldCalibration.load(filename)
+    except (OSError, ValueError, IndexError) as e:
+        raise ControlError("校正表読み込み失敗: " + str(e))
+
+
+def field_calibration() -> calibration.FieldCalibration:
+    if FIELD_CALIBRATION is not None:
+        return FIELD_CALIBRATION
+    return calibration.linear(Oe_CURRENT_CONST, Oe_LIMIT)
+
+
+def fields_to_ma(fields: list) -> list:
+    """
+    磁界の列をまとめて電流値に換算する
+    増加中の点は増加側、減少中の点は減少側の校正表を使う
+
+    Raise
+    -----
+    ControlError : Oe_LIMITまたは校正範囲を超えるとき
+
+    --------
+    :param fields: 磁界[Oe]の列
+    :return: 電流[mA]の列
+    """
+    for field in fields:
+        if abs(field) > Oe_LIMIT:
+            raise ControlError("{} Oe は上限 {} Oe を超えています".format(field, Oe_LIMIT))
+    direction = calibration.UP if not fields or fields[0] >= _last_field else calibration.DOWN
+    try:
+        return field_calibration().currents(fields, direction)
+    except ValueError as e:
+        raise ControlError(str(e))
+
+
+def oe_to_ma(target) -> int:
+    """
+    印加磁界を電流値に換算する
+    直前に設定した磁界より大きければ増加側、小さければ減少側の校正表を使う
+
+    --------
+    :param target: 磁界[Oe]
+    :return: 電流[mA]
+    """
+    return fields_to_ma([target])[0]
+
+
+def ctl_magnetic_field(target, settle: SettleCondition = POINT_SETTLE) -> float:
+    global _last_field
+    settle_time = ctl_iout_ma(oe_to_ma(target), 150, False, settle)
+    _last_field = target
+    return settle_time
+
+
+# 設定すると input_memo() は入力を待たずにこの値を返す (stations.py のワーカー用)
+MEMO = None
+
+
+def input_memo() -> str:
+    if MEMO is not None:
+        return MEMO
     print("測定条件等メモ記入欄")
-    memo = input("memo :")
+    return input("memo :")
+
+
+CSV_LABELS = ["経過時間[sec]", "設定電流:ISET[A]", "出力電流:IOUT[A]", "磁界:H[Gauss]", "出力電圧:VOUT[V]", "IFINE",
+              "安定時間[sec]", "磁界標準偏差[Gauss]", "磁界測定回数"]
+
+
+def csv_header_rows(start_time: datetime.datetime, memo: str) -> list:
+    return [["開始時刻", start_time.strftime('%Y-%m-%d_%H-%M-%S')],
+            ["memo", memo],
+            ["#####"],
+            CSV_LABELS]
+
+
+def gen_csv_header(filename) -> datetime:
+    memo = input_memo()
     start_time = datetime.datetime.now()
     with open(filename, mode='a', encoding="utf-8")as f:
         writer = csv.writer(f, lineterminator='\n')
-        writer.writerow(["開始時刻", start_time.strftime('%Y-%m-%d_%H-%M-%S')])
-        writer.writerow(["memo", memo])
-        writer.writerow(["#####"])
-        writer.writerow(["経過時間[sec]", "設定電流:ISET[A]", "出力電流:IOUT[A]", "磁界:H[Gauss]", "出力電圧:VOUT[V]", "IFINE"])
+        writer.writerows(csv_header_rows(start_time, memo))
     return start_time
 
 
+class CsvSession:
+    """
+    測定の間CSVファイルを開いたままにして書き込む
+    行はバッファに溜め、flush_rows行ごとまたはflush_interval秒ごとにディスクへ書き出す
+    with文を抜けるときは例外の有無にかかわらず終了時刻を書いて閉じる
+
+    --------
+    with CsvSession(savefile) as session:
+        start_time = session.write_header(input_memo())
+        session.add_status(status)
+    """
+
+    def __init__(self, filename: str, flush_rows: int = 20, flush_interval: float = 5.0, fsync: bool = False):
+        """
+        --------
+        :param filename:       書き込むファイル名
+        :param flush_rows:     この行数溜まったら書き出す
+        :param flush_interval: 前回の書き出しからこの秒数経ったら書き出す
+        :param fsync:          書き出しのたびにfsyncするか
+        """
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._file = None
+        self._writer = None
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def open(self) -> "CsvSession":
+        if self._file is None:
+            self._file = open(self.filename, mode='a', encoding="utf-8")
+            self._writer = csv.writer(self._file, lineterminator='\n')
+            self._last_flush = time.monotonic()
+        return self
+
+    def __enter__(self) -> "CsvSession":
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def write_header(self, memo: str) -> datetime.datetime:
+        """
+        ヘッダを書き込む
+
+        --------
+        :param memo: 測定条件等メモ
+        :return: 開始時刻
+        """
+        start_time = datetime.datetime.now()
+        self._writer.writerows(csv_header_rows(start_time, memo))
+        self.flush()
+        return start_time
+
+    def add_status(self, status: StatusList) -> None:
+        self.writerow(status.out_tuple())
+
+    def writerow(self, row) -> None:
+        with tracing.span("csv", "writerow"):
+            self._writer.writerow(row)
+            self._pending += 1
+            if self._pending >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self) -> None:
+        if self._file is None:
+            return
+        with tracing.span("csv", "flush"):
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        終了時刻を書き込んで閉じる
+        """
+        if self._file is None:
+            return
+        try:
+            self._writer.writerow(["終了時刻", get_time_str()])
+            self.flush()
+        finally:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+
+# 測定データの保存形式 "csv" または "run"(バイナリ形式 runfile.py)
+SAVE_FORMAT = "csv"
+# 記録点を別プロセスで H-I 曲線として表示する (liveplot.py)
+FLAG_LIVEPLOT = False
+
+
+def open_session(basename: str):
+    """
+    SAVE_FORMATに従って測定データの書き込み先を開く
+
+    --------
+    :param basename: 拡張子を除いたファイル名
+    :return: CsvSession または runfile.RunSession FLAG_LIVEPLOT のときは liveplot.PlottedSession で包む
+    """
+    if SAVE_FORMAT == "run":
+        session = runfile.RunSession(basename + ".run", CSV_LABELS)
+    else:
+        session = CsvSession(basename + ".csv")
+    if FLAG_LIVEPLOT:
+        import liveplot
+
+        return liveplot.PlottedSession(session, os.path.basename(basename))
+    return session
+
+
+def run_plan(plan: planner.SweepPlan, session, start_time: datetime.datetime,
+             settle: SettleCondition = POINT_SETTLE, echo: bool = False, dwell: float = 0.0) -> None:
+    """
+    掃引計画を順に書き込み、記録点では安定を待ってステータスを保存する
+    FLAG_ADAPTIVE_RAMP が真のときは、後に記録点が続くランプ途中の点を飛ばし、記録点の間を ramp_iset_ma() で動かす
+    折り返し点と最後の点、最後の記録点より後の点は必ず書き込み、どの点へも実際のISETからランプする
+
+    --------
+    :param plan:       掃引計画
+    :param session:    書き込み先
+    :param start_time: 測定開始時刻
+    :param settle:     記録点の安定判定条件
+    :param echo:       記録点のステータスを表示するか
+    :param dwell:      安定後、記録前に追加で待つ時間[sec]
+
+    Raise
+    -----
+    ControlError : WATCHDOG が異常を検出して掃引を止めたとき
+    """
+    with WATCHDOG:
+        _run_plan(plan, session, start_time, settle, echo, dwell)
+
+
+def _is_turning(plan: planner.SweepPlan, k: int, before: int) -> bool:
+    """
+    k番目の書き込みが折り返し点か最後の点か 飛ばすと行き過ぎや手前での停止になる
+
+    --------
+    :param before: 計画の最初の点の前のISET[mA]
+    """
+    if k + 1 >= len(plan):
+        return True
+    previous = plan.iset[k - 1] if k else before
+    return (plan.iset[k] - previous) * (plan.iset[k + 1] - plan.iset[k]) <= 0
+
+
+def plan_writes(plan: planner.SweepPlan, before: int) -> list:
+    """
+    run_plan() が書き込む点
+    FLAG_ADAPTIVE_RAMP のときは、後に記録点が続くランプ途中の点を省く その間は ramp_to() で動かす
+    折り返し点と最後の点、最後の記録点より後の点は省かない
+
+    --------
+    :param plan:   掃引計画
+    :param before: 計画の最初の点の前のISET[mA]
+    :return: [(書き込み番号, そこへ向かうランプ幅[mA]), ...]
+    """
+    writes = []
+    ramp_step = 100
+    last_logged = max((k for k in range(len(plan)) if plan.log[k]), default=-1)
+    for k in range(len(plan)):
+        if not plan.log[k]:
+            ramp_step = abs(plan.iset[k] - (plan.iset[k - 1] if k else before)) or ramp_step
+            if FLAG_ADAPTIVE_RAMP and k < last_logged and not _is_turning(plan, k, before):
+                continue
+        writes.append((k, ramp_step))
+    return writes
+
+
+def _run_plan(plan: planner.SweepPlan, session, start_time: datetime.datetime, settle: SettleCondition,
+              echo: bool, dwell: float) -> None:
+    written = A_to_mA(FetchIset())  # 最後に書き込んだ電流 計画の最初の点へも実際のISETからランプする
+    for k, ramp_step in plan_writes(plan, written):
+        current = plan.iset[k]
+        if not plan.log[k]:
+            with tracing.span("ramp", None, current):
+                ramp_to(written, current, ramp_step)
+                SetIsetMA(current)
+                wait_settle(current, RAMP_SETTLE)
+            written = current
+            continue
+        with tracing.span("point", None, current):
+            ramp_to(written, current, ramp_step)
+            SetIsetMA(current)
+            written = current
+            settle_time = wait_settle(current, settle)
+            if dwell > 0:
+                tracing.sleep(dwell)
+            status = loadStatus()
+            status.set_origine_time(start_time)
+            status.settle_second = settle_time
+            if echo:
+                print(status)
+            session.add_status(status)
+
+
 def measure() -> None:
     try:
         allow_power_output(True)
@@ -474,42 +1574,21 @@ def measure() -> None:
     check_point = [0, 5000, 0, -5000, 0]
     mesh = 500
     step = 100
-    count = 0
 
-    file_make_time_str = get_time_str()
-    savefile = file_make_time_str + ".csv"
-    start_time = gen_csv_header(savefile)
-
-    def log_prroces(target):
-        ctl_iout_ma(target, step, False)  # 測定電流
-        time.sleep(0.3)
-        status = loadStatus()
-        status.set_origine_time(start_time)
-        addSaveStatus(savefile, status)
-        return
+    plan = planner.current_plan(check_point, mesh, step, A_to_mA(FetchIout()))
+    print(plan)
 
-    for i in check_point:
-        if count == 0:
-            ctl_iout_ma(i, step)
-            count += 1
-            continue
-
-        iset_current = int(FetchIset() * 1000)
-        if i >= iset_current:
-            recode_point = range(iset_current, i, abs(mesh))
-        else:
-            recode_point = range(iset_current, i, abs(mesh) * -1)
-
-        for j in recode_point:
-            log_prroces(j)
+    file_make_time_str = get_time_str()
+    memo = input_memo()
 
-        log_prroces(i)
-        continue
+    try:
+        with open_session(file_make_time_str) as session:
+            start_time = session.write_header(memo)
+            run_plan(plan, session, start_time)
+    except ControlError as e:
+        print(e.message)
+        return
 
-    end_time = get_time_str()
-    with open(savefile, mode='a', encoding="utf-8")as f:
-        writer = csv.writer(f, lineterminator='\n')
-        writer.writerow(["終了時刻", end_time])
     print("Done")
 
 
@@ -527,40 +1606,78 @@ def Oe_measure():
     """
     check_point = [100, -100, 100]
     mesh = 10
-    set_field = 0
+    step = 150
 
     ctl_magnetic_field(0)
+    plan = planner.field_plan(check_point, mesh, step, fields_to_ma, oe_to_ma(0))
+    print(plan)
+
     file_make_time_str = get_time_str()
-    savefile = file_make_time_str + "磁歪.csv"
-    start_time = gen_csv_header(savefile)
-
-    def log_procces(target_gauss):
-        ctl_magnetic_field(target_gauss)
-        time.sleep(1)
-        status = loadStatus()
-        status.set_origine_time(start_time)
-        print(status)
-        time.sleep(1)
-        addSaveStatus(savefile, status)
+    memo = input_memo()
+
+    try:
+        with open_session(file_make_time_str + "磁歪") as session:
+            start_time = session.write_header(memo)
+            run_plan(plan, session, start_time, POINT_FIELD_SETTLE, echo=True)
+    except ControlError as e:
+        print(e.message)
         return
+    return_to_zero(check_point[-1])
+    print("Done")
 
-    for next_check_field in check_point:
-        if next_check_field > set_field:
-            recode_point = range(set_field, next_check_field, abs(mesh))
-        else:
-            recode_point = range(set_field, next_check_field, abs(mesh) * -1)
-        for apply_field in recode_point:
-            log_procces(apply_field)
-        log_procces(next_check_field)
-        set_field = next_check_field
-
-    end_time = get_time_str()
-    with open(savefile, mode='a', encoding="utf-8")as f:
-        writer = csv.writer(f, lineterminator='\n')
-        writer.writerow(["終了時刻", end_time])
 
+def return_to_zero(last_field: int) -> None:
+    """
+    磁界掃引の後に従来通り電流を0mAに戻す
+    ctl_magnetic_field(0) は校正表のヒステリシスで電流が残るので使わない
+    run_plan() は _last_field を更新しないので、終点を記録してから戻し、戻した後は0 Oeとする
+
+    --------
+    :param last_field: 掃引の終点[Oe]
+    """
+    set_last_field(last_field)
     ctl_iout_ma(0, 200, False)
-    print("Done")
+    set_last_field(0)
+
+
+# main.py meas() の記録点 従来はIOUTが±10mAに入るまで最大10回再試行し、記録点では5秒待っていた
+LIST_SETTLE = SettleCondition(tolerance_ma=10, slope_ma=50, timeout=5.0)
+
+
+def list_measure(points: list, start: int, stop: int, step: int = 10, hold: float = 1.0) -> None:
+    """
+    電流を step ずつ動かし、points の電流では安定を待ってから hold 秒後に記録する
+    main.py の ±3kG 測定の掃引 試料を飽和させるため、記録の前に start へ、後に最後の点へ必ず動かす
+
+    --------
+    :param points: 記録する電流[A]
+    :param start:  掃引開始電流[mA]
+    :param stop:   掃引終了電流[mA] この値は含まない
+    :param step:   刻み[mA]
+    :param hold:   安定後、記録前に止まる時間[sec]
+    """
+    SHADOW.invalidate()  # 呼び出し元が直接書き込んでいる場合がある
+    CanOutput(fresh=True)  # WATCHDOG はOUTの写しがないとISETとIOUTの差を確かめない
+    set_gauss_range()
+    plan = planner.list_plan(start, stop, step, points)
+    logged = {plan.iset[k] for k, _, _ in plan.points()}
+    missing = [point for point in points if int(round(point * 1000)) not in logged]
+    if missing:
+        print("[WARN]掃引範囲または刻みに合わない点は記録しません: {}".format(missing))
+    print(plan)
+
+    memo = input_memo()
+    try:
+        ctl_iout_ma(start, 100, settle=LIST_SETTLE)
+        with open_session(get_time_str() + "磁歪3kG") as session:
+            start_time = session.write_header(memo)
+            run_plan(plan, session, start_time, LIST_SETTLE, echo=True, dwell=hold)
+        if A_to_mA(FetchIset()) != plan.iset[-1]:
+            ctl_iout_ma(plan.iset[-1], step, settle=LIST_SETTLE)
+    except ControlError as e:
+        print(e.message)
+        return
+    print("finished\n")
 
 
 def usQueryGauss(s) -> None:
@@ -575,43 +1692,106 @@ def usQueryPower(s) -> None:
     print("<=: " + power.query(s))
 
 
+GAUSS_IDN = 'LSCI,MODEL421,0,010306\r\n'
+POWER_IDN = 'IDN PBX 40-10 VER1.13     KIKUSUI    \r\n'
+STARTUP_STATE_FILE = "startup_state.json"  # 前回 init() で確認した機器の状態
+STARTUP_STATE_TTL = 600.0  # この秒数以内に確認したレンジは問い合わせずに使う[sec]
+
+
+def _probe_gauss(previous: dict) -> tuple:
+    """
+    --------
+    :param previous: load_startup_state() の結果
+    :return: (IDN, レンジ, 前回の確認結果を使ったか) IDNが違う場合レンジはNone
+    """
+    idn = protocol.query_raw(gauss, protocol.GAUSS_IDN)
+    if idn != GAUSS_IDN:
+        return idn, None, False
+    if previous.get("gauss_idn") == idn and previous.get("range") == 0 and \
+            0 <= time.time() - previous.get("verified", 0) <= STARTUP_STATE_TTL:
+        # 写しとして持つので、SHADOW が verify_interval 以内に実機と照合する
+        SHADOW.store(protocol.RANGE, 0)
+        return idn, 0, True
+    return idn, SHADOW.fetch(gauss, protocol.RANGE, fresh=True), False
+
+
+def _probe_power() -> tuple:
+    idn = protocol.query_raw(power, protocol.IDN)
+    if idn != POWER_IDN:
+        return idn, None, None, None, None
+    return (idn, FetchIout(), SHADOW.fetch(power, protocol.ISET, fresh=True), CanOutput(fresh=True),
+            SHADOW.fetch(power, protocol.IFINE, fresh=True))
+
+
+def load_startup_state() -> dict:
+    try:
+        with open(STARTUP_STATE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_startup_state(state: dict) -> None:
+    temp = STARTUP_STATE_FILE + ".tmp"
+    with open(temp, mode="w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp, STARTUP_STATE_FILE)
+
+
 def init() -> None:
-    print("init....")
     """
     接続確認(始動動作)
+    2台の確認は並行して行い、既に目的の状態(レンジ0, 電流0, 出力ON)になっている項目は設定と待ちを省く
+    確認した状態は STARTUP_STATE_FILE に保存する 次回起動時は前回から変わった項目を表示し、
+    STARTUP_STATE_TTL 以内にレンジ0を確認していればレンジの問い合わせ・設定・待ちを省く
+    電源側は安全のため毎回実機から読む
     """
-    # ガウスメーターの接続確認
-    gaussconnection = gauss.query("*IDN?")
-
-    if gaussconnection == 'LSCI,MODEL421,0,010306\r\n':
+    print("init....")
+    start = time.monotonic()
+    previous = load_startup_state()
+    # ガウスメーターとバイポーラ電源の接続確認と状態の読み出しを並行して行う
+    gauss_side = _gauss_executor().submit(_probe_gauss, previous)
+    power_idn, iout, iset, output, ifine = _probe_power()
+    gauss_idn, gauss_range, range_cached = gauss_side.result()
+
+    if gauss_idn == GAUSS_IDN:
         print("gauss : connection confirmed")
 
     else:
         sys.exit("gauss : connection failed")
 
-    # バイポーラ電源の接続確認
-    powerconnection = power.query("IDN?")
-
-    if powerconnection == 'IDN PBX 40-10 VER1.13     KIKUSUI    \r\n':
+    if power_idn == POWER_IDN:
         print("power : connection confirmed")
 
     else:
         sys.exit("power : connection failed")
 
+    state = {"gauss_idn": gauss_idn, "power_idn": power_idn, "range": gauss_range, "iset": iset, "output": output,
+             "ifine": ifine}
+    changed = [key for key in state if key in previous and previous[key] != state[key]]
+    if previous and not changed:
+        print("前回確認した状態から変化なし")
+    elif changed:
+        print("前回確認した状態から変わった項目: " + ", ".join(changed))
+    if range_cached:
+        print("ガウスメーターのレンジは前回の確認結果(0)を使用")
+
     # ガウスメーターのレンジを最低感度に設定
-    set_gauss_range()
-    time.sleep(1.0)
-    gaussrange = gauss.query("RANGE?")  # 現在の設定レンジの問い合わせ
-    if gaussrange == '0\r\n':
-        print('ガウスメーターのレンジが最大に変更されました')
+    if gauss_range != 0:
+        set_gauss_range()
+        tracing.sleep(1.0)
+        gauss_range = SHADOW.fetch(gauss, protocol.RANGE, fresh=True)  # 現在の設定レンジの問い合わせ
+        if gauss_range == 0:
+            print('ガウスメーターのレンジが最大に変更されました')
 
-    else:
-        print('ガウスメーターのレンジを確認してください')
-    # バイポーラ電源の初期化
-    ctl_iout_ma(0, 100, False)
-    current = FetchIout()
+        else:
+            print('ガウスメーターのレンジを確認してください')
+    # バイポーラ電源の初期化 出力中の電流が既に0ならランプを省く
+    if abs(iout) >= 0.01 or (output and abs(iset) >= 0.01):
+        ctl_iout_ma(0, 100, False)
+        iout = FetchIout()
 
-    if abs(current) < 0.01:
+    if abs(iout) < 0.01:
         print("normal state\n")
 
     else:
@@ -624,17 +1804,32 @@ def init() -> None:
     except Exception:
         print("バイポーラ電源制御異常")
         raise
-    print('\n初期化が完了しました。\nコマンドリストを開くにはcommandと入力してください。\n')
+    # 前回の確認結果を使ったときは確認時刻を更新しない 使い続けても STARTUP_STATE_TTL で実機を読み直す
+    verified = previous["verified"] if range_cached else time.time()
+    state.update({"range": gauss_range, "iset": FetchIset(), "output": True, "time": get_time_str(),
+                  "verified": verified})
+    try:
+        save_startup_state(state)
+    except OSError as e:
+        print(e)
+    print('\n初期化が完了しました。({:.2f} 秒)\nコマンドリストを開くにはcommandと入力してください。\n'.format(
+        time.monotonic() - start))
 
 
 def after_operations() -> None:
     print("終了処理を開始します。")
     try:
         allow_power_output(False)
+        state = load_startup_state()
+        if state:
+            state.update({"iset": FetchIset(), "output": False, "time": get_time_str()})
+            save_startup_state(state)
     except ControlError:
         print("バイポーラ電源制御異常")
         ctl_iout_ma(0)
     finally:
+        gauss.close()
+        power.close()
         print("終了")
 
 
@@ -642,9 +1837,17 @@ def cmdlist() -> None:
     print("""
 help        :コマンド一覧
 measure     :測定
+ameasure    :測定(asyncio版 記録と次の点へのランプを重ねる)
+cmeasure    :連続掃引測定
+stations    :stations.json の全ステーションで同時に測定
+recipe      :掃引レシピ(.toml/.json)を順に実行 dry で点数と予想時間のみ表示
 ctlIout     :出力電流を設定
 status      :現時点の測定結果を表示
 savestatus  :現時点の測定結果をファイルに保存
+stats       :コマンド毎の通信回数と往復時間を表示
+export      :バイナリ形式(.run)の測定データをCSVに書き出す
+health      :機器の応答時間と再接続回数を表示
+trace       :所要時間の記録を開始/停止 停止時に trace_*.json (chrome://tracing 形式)と集計を出力
 exit        :終了
 """)
 
@@ -661,7 +1864,10 @@ def cmdCtlIout() -> None:
 def cmd_ctl_gauss():
     print("Target applied field(Oe)")
     target = float(input(">>>>>"))
-    ctl_magnetic_field(target)
+    try:
+        ctl_magnetic_field(target)
+    except ControlError as e:
+        print(e.message)
 
 
 FLAG_AUTOFINE = False
@@ -671,6 +1877,13 @@ def cmd_change_flags() -> None:
     print("""
     1,FLAG_AUTOFINE
     2,Oe_CURRENT_CONST
+    3,IFINE table reset
+    4,field calibration file
+    5,FIELD_SAMPLES
+    6,SAVE_FORMAT
+    7,FLAG_ADAPTIVE_RAMP
+    8,FLAG_WATCHDOG
+    9,FLAG_LIVEPLOT
     """)
     target = int(input(">>>>>"))
     if target == 1:
@@ -697,6 +1910,76 @@ def cmd_change_flags() -> None:
         except ValueError:
             print("invalid value. Please Enter float!")
             return
+    elif target == 3:
+        IFINE_TABLE.invalidate()
+        print("IFINE table cleared")
+        return
+    elif target == 4:
+        global FIELD_CALIBRATION
+        print("field calibration csv (empty: use Oe_CURRENT_CONST)")
+        filename = input("file = ")
+        if filename == "":
+            FIELD_CALIBRATION = None
+            return
+        try:
+            load_field_calibration(filename)
+        except ControlError as e:
+            print(e.message)
+        return
+    elif target == 5:
+        global FIELD_SAMPLES
+        print("FIELD_SAMPLES is int (1-{})".format(len(FIELD_RING.buffer)))
+        print("FIELD_SAMPLES = ", str(FIELD_SAMPLES))
+        try:
+            FIELD_SAMPLES = max(1, min(len(FIELD_RING.buffer), int(input("FIELD_SAMPLES = "))))
+        except ValueError:
+            print("invalid value. Please Enter int!")
+        return
+    elif target == 6:
+        global SAVE_FORMAT
+        print("SAVE_FORMAT is csv or run")
+        print("SAVE_FORMAT = ", SAVE_FORMAT)
+        ans = input("SAVE_FORMAT = ")
+        if ans in {"csv", "run"}:
+            SAVE_FORMAT = ans
+        else:
+            print("csv or run")
+        return
+    elif target == 7:
+        global FLAG_ADAPTIVE_RAMP
+        print("FLAG_ADAPTIVE_RAMP is bool. T or F")
+        print("R= {} L= {} tau= {}".format(COIL.resistance, COIL.inductance, COIL.tau))
+        ans = input("FLAG_ADAPTIVE_RAMP = ")
+        if ans == "T":
+            FLAG_ADAPTIVE_RAMP = True
+        elif ans == "F":
+            FLAG_ADAPTIVE_RAMP = False
+        else:
+            print("True is T. False is F. ")
+        return
+    elif target == 8:
+        global FLAG_WATCHDOG
+        print("FLAG_WATCHDOG is bool. T or F")
+        print("trips= {}".format(WATCHDOG.events))
+        ans = input("FLAG_WATCHDOG = ")
+        if ans == "T":
+            FLAG_WATCHDOG = True
+        elif ans == "F":
+            FLAG_WATCHDOG = False
+        else:
+            print("True is T. False is F. ")
+        return
+    elif target == 9:
+        global FLAG_LIVEPLOT
+        print("FLAG_LIVEPLOT is bool. T or F")
+        ans = input("FLAG_LIVEPLOT = ")
+        if ans == "T":
+            FLAG_LIVEPLOT = True
+        elif ans == "F":
+            FLAG_LIVEPLOT = False
+        else:
+            print("True is T. False is F. ")
+        return
 
     else:
         print(str(target) + " is not defined.")
@@ -715,6 +1998,41 @@ def main() -> None:
             # measure()
             Oe_measure()
 
+        elif cmd == "ameasure":
+            import asyncio
+            import async_driver
+
+            asyncio.run(async_driver.Oe_measure_async())
+
+        elif cmd == "cmeasure":
+            import continuous
+
+            continuous.continuous_measure()
+
+        elif cmd == "stations":
+            import stations
+
+            try:
+                station_list = stations.load_stations()
+            except (OSError, ValueError, KeyError) as e:
+                print("{} を読み込めません: {}".format(stations.STATIONS_FILE, e))
+                continue
+            sweep = input("sweep ({}) = ".format("/".join(stations.SWEEPS))) or stations.SWEEPS[0]
+            memos = {}
+            for station in station_list:
+                print("[{}]".format(station.name))
+                memos[station.name] = input_memo()
+            # このPCの機器をステーションにした場合に子プロセスが開けるよう閉じておく 次に使うときに開き直す
+            gauss.close()
+            power.close()
+            print(stations.summary(stations.run_stations(station_list, sweep, memos)))
+
+        elif cmd in {"recipe", "recipe dry"}:
+            import recipe
+
+            filenames = input("recipe files = ").split()
+            recipe.run_queue(filenames, dry_run=cmd.endswith("dry"))
+
         elif cmd == "ctlIout":
             cmdCtlIout()
 
@@ -723,15 +2041,45 @@ def main() -> None:
 
         elif cmd == "status":
 
-            status = loadStatus()
+            status = loadStatus(max_age=STATUS_CACHE.max_age, ages=STATUS_AGES)
             print(status)
 
+        elif cmd == "export":
+            filename = input("run file = ")
+            try:
+                count = runfile.export_csv(filename, os.path.splitext(filename)[0] + ".csv")
+                print("{} 点を書き出しました".format(count))
+            except (OSError, ValueError) as e:
+                print(e)
+
+        elif cmd == "stats":
+            print(protocol.stats_table())
+            print(SHADOW.report())
+            print(STATUS_CACHE.report())
+
+        elif cmd == "health":
+            for resource in (gauss, power):
+                resource.probe()
+                print(resource.report())
+
+        elif cmd == "trace":
+            if not tracing.ENABLED:
+                tracing.reset()
+                tracing.enable()
+                print("trace on")
+            else:
+                tracing.disable()
+                filename = "trace_" + datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".json"
+                count = tracing.export_chrome(filename)
+                print("{} 区間を {} に書き出しました".format(count, filename))
+                print(tracing.summary())
+
         elif cmd == "savestatus":
             now = datetime.datetime.now()
             start_time = "%s-%s-%s_%s-%s-%s" % (now.year, now.month, now.day, now.hour, now.minute, now.second)
             savefile = start_time + ".csv"
             gen_csv_header(savefile)
-            status = loadStatus()
+            status = loadStatus(max_age=STATUS_CACHE.max_age, ages=STATUS_AGES)
             print(status)
             addSaveStatus(savefile, status)
 
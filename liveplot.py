@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+測定中の H-I 曲線のライブ表示
+
+掃引側は記録点を上限付きのキューに入れるだけで、描画は別プロセスで行う。
+キューが一杯のときはその点を捨てて数えるだけなので、掃引が描画を待つことはない。
+描画側は REFRESH 秒ごとにキューに溜まった点をまとめて取り出して1回だけ描き直し、
+MAX_POINTS を超えたら1点おきに間引く。
+matplotlib がなければ画面に1行の要約を出す。
+
+    with liveplot.PlottedSession(helmcoil.open_session(name), name) as session:
+        session.add_status(status)  # CSVに書いてからキューに入れる
+"""
+import multiprocessing
+import queue
+import time
+
+QUEUE_SIZE = 256   # 描画待ちの点の上限 超えた点は捨てる
+REFRESH = 0.5      # 描き直す間隔[sec]
+MAX_POINTS = 2000  # 表示する点の上限 超えたら1点おきに間引く
+
+
+class LivePlot:
+    """
+    描画プロセスとそこへのキュー
+    """
+
+    def __init__(self, title: str = "", queue_size: int = QUEUE_SIZE, refresh: float = REFRESH,
+                 max_points: int = MAX_POINTS):
+        self.title = title
+        self.queue_size = queue_size
+        self.refresh = refresh
+        self.max_points = max_points
+        self.dropped = 0
+        self._queue = None
+        self._process = None
+
+    def start(self) -> "LivePlot":
+        # 描画はGUIのメインスレッドが必要で、GILも掃引と取り合わないよう別プロセスにする
+        context = multiprocessing.get_context("spawn")
+        self._queue = context.Queue(self.queue_size)
+        self._process = context.Process(target=_consume, name="liveplot", daemon=True,
+                                        args=(self._queue, self.title, self.refresh, self.max_points))
+        self._process.start()
+        return self
+
+    def push(self, status) -> None:
+        """
+        記録点をキューに入れる 決して待たない
+        """
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait((status.diff_second, status.iout, status.field, self.dropped))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """
+        描画側に終わりを知らせる ウィンドウは閉じられるまで残す
+        """
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            self._process.terminate()
+        self._queue.close()
+        self._queue = None
+        if self.dropped:
+            print("[WARN]liveplot: {} 点を表示せずに捨てました".format(self.dropped))
+
+
+class PlottedSession:
+    """
+    open_session() の書き込み先を包み、add_status() した点を LivePlot にも送る
+    """
+
+    def __init__(self, session, title: str = ""):
+        self.session = session
+        self.plot = LivePlot(title)
+
+    def __enter__(self) -> "PlottedSession":
+        self.session.__enter__()
+        try:
+            self.plot.start()
+        except OSError as e:
+            print("[WARN]liveplot を起動できません: {}".format(e))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.plot.close()
+        return self.session.__exit__(exc_type, exc_val, exc_tb)
+
+    def add_status(self, status) -> None:
+        self.session.add_status(status)
+        self.plot.push(status)
+
+    def __getattr__(self, name: str):
+        return getattr(self.session, name)
+
+
+def _consume(source, title: str, refresh: float, max_points: int) -> None:
+    """
+    描画プロセスの本体
+    """
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        plt = None
+
+    current, field = [], []
+    step = 1     # 間引き後の点の間隔
+    skipped = 0  # 間引きで次に捨てるまでの数
+    dropped = 0
+    figure = line = marker = None
+    if plt is not None:
+        plt.ion()
+        figure, axes = plt.subplots()
+        axes.set_xlabel("IOUT [A]")
+        axes.set_ylabel("Field [Oe]")
+        axes.set_title(title)
+        line, = axes.plot([], [], ".-", markersize=3)
+        marker, = axes.plot([], [], "o", color="red")
+
+    finished = False
+    while not finished:
+        # 最初の1点を待ち、残りはまとめて取り出す
+        batch = []
+        deadline = time.monotonic() + refresh
+        while not finished:
+            try:
+                record = source.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if record is None:
+                finished = True
+            else:
+                batch.append(record)
+        if plt is not None and not plt.fignum_exists(figure.number):
+            # ウィンドウを閉じたら以降の点は読み捨てる
+            plt = None
+            continue
+        if not batch:
+            if plt is not None:
+                plt.pause(0.001)
+            continue
+
+        for _, iout, value, dropped in batch:
+            skipped += 1
+            if skipped < step:
+                continue
+            skipped = 0
+            current.append(iout)
+            field.append(value)
+        if len(current) > max_points:
+            del current[1::2], field[1::2]
+            step *= 2
+        last = batch[-1]
+
+        if plt is not None:
+            line.set_data(current, field)
+            marker.set_data([last[1]], [last[2]])
+            line.axes.relim()
+            line.axes.autoscale_view()
+            figure.canvas.draw_idle()
+            plt.pause(0.001)
+        else:
+            print("[plot] {:03} sec IOUT= {:+.3f} Field= {:+.1f} ({} 点{})".format(
+                last[0], last[1], last[2], len(current), " / 捨てた点 {}".format(dropped) if dropped else ""))
+
+    if plt is not None:
+        plt.ioff()
+        plt.show()
@@ -13,9 +13,12 @@ import time
 
 import visa
 
+GAUSS_ADDR = "ASRL3::INSTR"
+POWER_ADDR = "GPIB0::4::INSTR"
+
 rm = visa.ResourceManager()
-gauss = rm.open_resource("ASRL3::INSTR")
-power = rm.open_resource("GPIB0::4::INSTR")
+gauss = rm.open_resource(GAUSS_ADDR)
+power = rm.open_resource(POWER_ADDR)
 
 
 def ioutfunc():  # 出力電流の関数
@@ -472,11 +475,47 @@ def app():
 """
 メイン測定処理
 """
-# ユーザー設定電流値(この電流値の時に5sec止まる）
+# ユーザー設定電流値(この電流値で出力が安定した後、HOLD_SECOND秒止まる）
 # 測定点を増やす場合は、カメラの録画時間を考慮して設定すること。(設定後、録画時間内に収まるか試すのが望ましい)
-# 25点測定で約5分30秒
+# 25点測定で約5分30秒 (止まる時間の合計は 25 x HOLD_SECOND 秒)
 applied_field1 = [3.00, 2.00, 1.00, 0.75, 0.60, 0.50, 0.40, 0.30, 0.20, 0.15, 0.10, 0.05, 0.00]
 applied_field2 = [-0.05, -0.10, -0.15, -0.20, -0.30, -0.40, -0.50, -0.60, -0.75, -1.00, -2.00, -3.00]
+# 各点でカメラに記録させるために止まる時間[sec] 出力の安定待ちとは別 安定してから数える
+HOLD_SECOND = 5.0
+
+
+_engine_connections = None
+
+
+def _engine_opener(name):
+    """
+    このスクリプトで開いた機器を返す 通信エラーで Connection に閉じられた後は開き直して差し替える
+    """
+    opened = []
+
+    def opener(address):
+        if opened:
+            globals()[name] = rm.open_resource(address)
+        opened.append(address)
+        return globals()[name]
+    return opener
+
+
+def engine_meas(start, stop):
+    """
+    helmcoil の掃引エンジンで start[mA] から stop[mA] の手前まで10mAずつ動かし、
+    applied_field1/2 の電流で出力の安定を待ってから記録する 結果はCSVにも保存される
+    """
+    global _engine_connections
+    import connection
+    import helmcoil
+
+    # 掃引中は WATCHDOG のスレッドも同じ機器に問い合わせるので、ロックのある Connection で包んで渡す
+    if _engine_connections is None:
+        _engine_connections = (connection.Connection("gauss", GAUSS_ADDR, "*IDN?", opener=_engine_opener("gauss")),
+                               connection.Connection("power", POWER_ADDR, "IDN?", opener=_engine_opener("power")))
+    helmcoil.gauss, helmcoil.power = _engine_connections
+    helmcoil.list_measure(applied_field1 + applied_field2, start, stop, 10, HOLD_SECOND)
 
 
 def meas():
@@ -544,337 +583,16 @@ def meas():
     elif float(meascurrent) >= 3:
         print('start measurement +3kG ⇒ -3kG')
         timeget()
-
-        for i in range(3200, -3200, -10):  # 3.2Aから-3.1Aまで0.1Aずつ減少させる
-            if i >= 0:  # 設定電流値が正のときの処理
-                count = 0
-                while 1:
-                    value = i / 1000
-                    iset = "ISET " + "%.2f" % (value)  # 小数点以下2桁
-                    power.write(iset)
-                    ioutfunc()
-                    over = "%.2f" % (value + 0.01)
-                    under = "%.2f" % (value - 0.01)
-                    meascurrent = "%.2f" % (float(current))
-                    time.sleep(0.1)
-                    count += 1
-
-                    if float(meascurrent) <= float(over) and float(meascurrent) >= float(under):
-                        break
-
-                    elif count == 10:  # 10回リトライしたらタイムアウト
-                        print("timeout")
-                        while 1:
-                            print('if you want initialize --> init')
-                            print('if you want apply to +3kG --> plus')
-                            print('if you want apply to -3kG --> minus')
-                            print('\n')
-                            cmd = input('input any commands >>> ')
-
-                            if cmd == 'init':  # 初期化
-                                init()
-                                break
-
-                            elif cmd == 'plus':  # +3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) >= 3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) < 3:
-                                    app_plus()
-                                    break
-
-                            elif cmd == 'minus':  # -3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) <= -3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) > -3:
-                                    app_minus()
-                                    break
-
-                            elif cmd == 'command':  # コマンドリストの表示
-                                command()
-
-                            elif cmd == 'end':  # 終了コマンド
-                                init()
-
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) < 0.009 and float(meascurrent) > -0.009:
-                                    power.write("OUT 0")
-                                    print('turn off state')
-                                    break
-
-                            else:
-                                print('this command is not define or you cannot use now')
-
-                for j in applied_field1:  # applied_field1のリストと比較
-                    if value == j:  # リスト内の電流値とマッチしていれば測定
-                        print('measuring...')
-                        timeget()
-                        time.sleep(5.0)  # 5sec待機
-                        timeget()
-                        ioutfunc()
-                        print(current + 'A')  # 測定電流値を表示
-                        fieldfunc()
-                        print(field + '\n')  # 測定磁界を表示
-
-            elif i < 0:  # 設定電流値が負のときの処理
-                count = 0
-                while 1:
-                    value = i / 1000
-                    iset = "ISET " + "%.2f" % (value)  # 小数点以下2桁
-                    power.write(iset)
-                    ioutfunc()
-                    over = "%.2f" % (value + 0.01)
-                    under = "%.2f" % (value - 0.01)
-                    meascurrent = "%.2f" % (float(current))
-                    time.sleep(0.1)
-                    count += 1
-
-                    if float(meascurrent) <= float(over) and float(meascurrent) >= float(under):
-                        break
-
-                    elif count == 10:  # 10回リトライしたらタイムアウト
-                        print("timeout")
-                        while 1:
-                            print('if you want initialize --> init')
-                            print('if you want apply to +3kG --> plus')
-                            print('if you want apply to -3kG --> minus')
-                            print('\n')
-                            cmd = input('input any commands >>> ')
-
-                            if cmd == 'init':  # 初期化
-                                init()
-                                break
-
-                            elif cmd == 'plus':  # +3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) >= 3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) < 3:
-                                    app_plus()
-                                    break
-
-                            elif cmd == 'minus':  # -3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) <= -3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) > -3:
-                                    app_minus()
-                                    break
-
-                            elif cmd == 'command':  # コマンドリストの表示
-                                command()
-
-                            elif cmd == 'end':  # 終了コマンド
-                                init()
-
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) < 0.009 and float(meascurrent) > -0.009:
-                                    power.write("OUT 0")
-                                    print('turn off state')
-                                    break
-
-                            else:
-                                print('this command is not define or you cannot use now')
-
-                for j in applied_field2:  # applied_field1のリストと比較
-                    if value == j:  # リスト内の電流値とマッチしていれば測定
-                        print('measuring...')
-                        timeget()
-                        time.sleep(5.0)  # 5sec待機
-                        timeget()
-                        ioutfunc()
-                        print(current + 'A')  # 測定電流値を表示
-                        fieldfunc()
-                        print(field + '\n')  # 測定磁界を表示
-
-            elif i == -3100:  # 電流値が-3.1Aのとき
-                print('finished\n')
-
+        engine_meas(3200, -3200)  # 3.2Aから-3.19Aまで0.01Aずつ減少させる
+        timeget()
 
     # 電流が-3A流れていれば-3kG ⇒ +3kGまで測定
     elif float(meascurrent) < -3:
         print('start measurment -3kG ⇒ +3kG')
         timeget()
+        engine_meas(-3200, 3200)  # -3.2Aから3.19Aまで0.01Aずつ増加させる
+        timeget()
 
-        for i in range(-3200, 3200, 10):  # -3.2Aから3.1Aまで0.1Aずつ増加させる
-            if i >= 0:  # 設定電流値が正のときの処理
-                count = 0
-                while 1:
-                    value = i / 1000
-                    iset = "ISET " + "%.2f" % (value)  # 小数点以下2桁
-                    power.write(iset)
-                    ioutfunc()
-                    over = "%.2f" % (value + 0.01)
-                    under = "%.2f" % (value - 0.01)
-                    meascurrent = "%.2f" % (float(current))
-                    time.sleep(0.1)
-                    count += 1
-
-                    if float(meascurrent) <= float(over) and float(meascurrent) >= float(under):
-                        break
-
-                    elif count == 10:  # 10回リトライしたらタイムアウト
-                        print("timeout")
-                        while 1:
-                            print('if you want initialize --> init')
-                            print('apply +3kG --> plus')
-                            print('apply -3kG --> minus')
-                            print('\n')
-                            cmd = input('input any commands >>> ')
-
-                            if cmd == 'init':  # 初期化
-                                init()
-                                break
-
-                            elif cmd == 'plus':  # +3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) >= 3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) < 3:
-                                    app_plus()
-                                    break
-
-                            elif cmd == 'minus':  # -3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) <= -3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) > -3:
-                                    app_minus()
-                                    break
-
-                            elif cmd == 'command':  # コマンドリストの表示
-                                command()
-
-                            elif cmd == 'end':  # 終了コマンド
-                                init()
-
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) < 0.009 and float(meascurrent) > -0.009:
-                                    power.write("OUT 0")
-                                    print('turn off state')
-                                    break
-
-                            else:
-                                print('this command is not define or you cannot use now')
-
-                for j in applied_field1:  # applied_field1のリストと比較
-                    if value == j:  # リスト内の電流値とマッチしていれば測定
-                        print('measuring...')
-                        timeget()
-                        time.sleep(5.0)  # 5sec待機
-                        timeget()
-                        ioutfunc()
-                        print(current + 'A')  # 測定電流値を表示
-                        fieldfunc()
-                        print(field + '\n')  # 測定磁界を表示
-
-
-            elif i < 0:  # 設定電流値が負のときの処理
-                count = 0
-                while 1:
-                    value = i / 1000
-                    iset = "ISET " + "%.2f" % (value)  # 小数点以下2桁
-                    power.write(iset)
-                    ioutfunc()
-                    over = "%.2f" % (value + 0.01)
-                    under = "%.2f" % (value - 0.01)
-                    meascurrent = "%.2f" % (float(current))
-                    time.sleep(0.1)
-                    count += 1
-
-                    if float(meascurrent) <= float(over) and float(meascurrent) >= float(under):
-                        break
-
-                    elif count == 10:  # 10回リトライしたらタイムアウト
-                        print("timeout")
-                        while 1:
-                            print('if you want initialize --> init')
-                            print('apply +3kG --> plus')
-                            print('apply -3kG --> minus')
-                            print('\n')
-                            cmd = input('input any commands >>> ')
-
-                            if cmd == 'init':  # 初期化
-                                init()
-                                break
-
-                            elif cmd == 'plus':  # +3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) >= 3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) < 3:
-                                    app_plus()
-                                    break
-
-                            elif cmd == 'minus':  # -3kG印加
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) <= -3:
-                                    print('field is already applied!!')
-
-                                elif float(meascurrent) > -3:
-                                    app_minus()
-                                    break
-
-                            elif cmd == 'command':
-                                command()
-
-                            elif cmd == 'end':  # 終了コマンド
-                                init()
-
-                                ioutfunc()
-                                meascurrent = "%.2f" % (float(current))
-
-                                if float(meascurrent) < 0.009 and float(meascurrent) > -0.009:
-                                    power.write("OUT 0")
-                                    print('turn off state')
-                                    break
-
-                            else:
-                                print('this command is not define or you cannot use now')
-
-                for j in applied_field2:  # applied_field1のリストと比較
-                    if value == j:  # リスト内の電流値とマッチしていれば測定
-                        print('measuring...')
-                        timeget()
-                        time.sleep(5.0)  # 5sec待機
-                        timeget()
-                        ioutfunc()
-                        print(current + 'A')  # 測定電流値を表示
-                        fieldfunc()
-                        print(field + '\n')  # 測定磁界を表示
-
-            elif i == 3100:  # 電流値が3.1Aのとき
-                print('finished\n')
 
 
 """
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+掃引計画
+
+チェックポイント・測定間隔・ランプ幅から、測定前に全てのISET書き込みと測定点を配列として作っておく。
+実行側は配列を順に書き込むだけなので、測定点ごとにIOUTを読み直してランプを組み立て直す必要がない。
+"""
+from array import array
+
+# 所要時間見積もりの既定値[sec]
+WRITE_SECOND = 0.008   # ISET書き込み1回
+RAMP_SECOND = 0.05     # ランプ途中1ステップの到達待ち
+POINT_SECOND = 0.15    # 測定点の安定待ち
+STATUS_SECOND = 0.05   # loadStatus 1回
+FIELD_SECOND = 0.035   # FIELD? 1回 (平均化で追加する読み取り)
+
+
+class SweepPlan:
+    """
+    ISET書き込み列
+
+    iset[k]  : k番目に書き込む電流[mA]
+    log[k]   : 1ならk番目の書き込み後に安定を待って記録する
+    label[k] : 記録点の表示用の値(磁界掃引ならOe、電流掃引ならmA) 記録しない点は0
+    """
+
+    def __init__(self, unit: str = "mA"):
+        self.unit = unit
+        self.iset = array('i')
+        self.log = array('b')
+        self.label = array('d')
+
+    def __len__(self) -> int:
+        return len(self.iset)
+
+    def __str__(self) -> str:
+        return "ISET書き込み {} 回 / 測定点 {} 点 / 予想時間 {:.0f} 秒".format(
+            len(self.iset), self.point_count(), self.estimate_seconds())
+
+    def append(self, current: int, log: bool = False, label: float = 0.0) -> None:
+        """
+        書き込みを追加する
+        直前と同じ電流の書き込みは省く ただし記録点が続く場合はそれぞれ記録する
+        """
+        if len(self.iset) and self.iset[-1] == current and not (log and self.log[-1]):
+            if log:
+                self.log[-1] = 1
+                self.label[-1] = label
+            return
+        self.iset.append(current)
+        self.log.append(1 if log else 0)
+        self.label.append(label)
+
+    def ramp(self, start: int, target: int, step: int, log: bool = False, label: float = 0.0) -> None:
+        """
+        ctl_iout_ma と同じ刻みで start から target までの書き込みを追加する
+        """
+        step = abs(step) or 100
+        if step > 300:
+            step = 300
+        if start != target:
+            for current in range(start, target, step if start < target else -step):
+                self.append(current)
+        self.append(target, log, label)
+
+    def point_count(self) -> int:
+        return sum(self.log)
+
+    def points(self) -> list:
+        """
+        :return: [(書き込み番号, ISET[mA], 表示値), ...] 記録点のみ
+        """
+        return [(k, self.iset[k], self.label[k]) for k in range(len(self.iset)) if self.log[k]]
+
+    def estimate_seconds(self, write: float = WRITE_SECOND, ramp: float = RAMP_SECOND,
+                         point: float = POINT_SECOND, status: float = STATUS_SECOND) -> float:
+        points = self.point_count()
+        return len(self.iset) * write + (len(self.iset) - points) * ramp + points * (point + status)
+
+    def describe(self) -> str:
+        lines = [str(self), "No.    ISET[mA]  {}".format(self.unit)]
+        for k, current, label in self.points():
+            lines.append("{:<6} {:>8}  {:+g}".format(k, current, label))
+        return "\n".join(lines)
+
+
+def segment(start, stop, mesh) -> range:
+    """
+    start から stop の手前まで mesh 間隔の点 (向きは start と stop から決める)
+    """
+    if stop >= start:
+        return range(start, stop, abs(mesh))
+    return range(start, stop, abs(mesh) * -1)
+
+
+def current_plan(check_point: list, mesh: int, step: int, start: int = 0) -> SweepPlan:
+    """
+    measure() の電流掃引を計画にする
+    最初のチェックポイントへは記録せずに移動し、以降はmeshごとに記録する
+
+    --------
+    :param check_point: 折り返し電流[mA] [0, 5000, 0, -5000, 0]
+    :param mesh:        記録間隔[mA]
+    :param step:        ランプ幅[mA]
+    :param start:       現在の設定電流[mA]
+    :return: SweepPlan
+    """
+    plan = SweepPlan("mA")
+    plan.ramp(start, check_point[0], step)
+    previous = check_point[0]
+    for next_point in check_point[1:]:
+        for current in list(segment(previous, next_point, mesh)) + [next_point]:
+            plan.ramp(plan.iset[-1], current, step, True, current)
+        previous = next_point
+    return plan
+
+
+def field_plan(check_point: list, mesh: int, step: int, fields_to_ma, start: int = 0) -> SweepPlan:
+    """
+    Oe_measure() の磁界掃引を計画にする
+    0 Oe へ移動してから check_point を順に巡り、meshごとに記録する
+    磁界から電流への換算は全点まとめて1回で行う
+
+    --------
+    :param check_point:  折り返し磁界[Oe] [100, -100, 100]
+    :param mesh:         記録間隔[Oe]
+    :param step:         ランプ幅[mA]
+    :param fields_to_ma: 磁界[Oe]の列を電流[mA]の列に換算する関数
+    :param start:        現在の設定電流[mA]
+    :return: SweepPlan
+    """
+    fields = [0]
+    set_field = 0
+    for next_field in check_point:
+        fields.extend(segment(set_field, next_field, mesh))
+        fields.append(next_field)
+        set_field = next_field
+    currents = fields_to_ma(fields)
+
+    plan = SweepPlan("Oe")
+    plan.ramp(start, currents[0], step)
+    for field, current in zip(fields[1:], currents[1:]):
+        plan.ramp(plan.iset[-1], current, step, True, field)
+    return plan
+
+
+def list_plan(start: int, stop: int, step: int, points: list, current: int = None) -> SweepPlan:
+    """
+    main.py meas() の掃引を計画にする
+    start から stop の手前まで step ずつ動かし、points に含まれる電流で記録する
+
+    --------
+    :param start:   掃引開始電流[mA] 3200
+    :param stop:    掃引終了電流[mA] この値は含まない -3200
+    :param step:    刻み[mA] 10
+    :param points:  記録する電流[A] applied_field1 + applied_field2
+    :param current: 現在の設定電流[mA] 指定すると start まで記録せずに移動する
+    :return: SweepPlan
+    """
+    targets = {int(round(point * 1000)) for point in points}
+    plan = SweepPlan("A")
+    if current is not None:
+        plan.ramp(current, start, step)
+    for value in segment(start, stop, step):
+        plan.append(value, value in targets, value / 1000)
+    return plan
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+PBX 40-10 / Model 421 のコマンド定義
+
+各コマンドの応答書式を正規表現で事前にコンパイルしておき、型変換と値域の確認を行う。
+コマンド毎に呼び出し回数と往復時間(最小/平均/最大)を記録する。
+"""
+import re
+import time
+
+import tracing
+
+
+class ProtocolError(ValueError):
+    """
+    応答の解析失敗または値域外の値
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class Command:
+    """
+    1つのコマンドの定義と統計
+    """
+
+    def __init__(self, instrument: str, header: str, pattern: str = None, kind=str,
+                 minimum=None, maximum=None, write_format: str = None):
+        """
+        --------
+        :param instrument:   "power" または "gauss"
+        :param header:       コマンド文字列 "IOUT?" / "ISET"
+        :param pattern:      応答から値を取り出す正規表現 グループ1が値
+        :param kind:         値の型 float/int/bool/str
+        :param minimum:      値の下限
+        :param maximum:      値の上限
+        :param write_format: 書き込みコマンドの書式 "ISET {:.3f}"
+        """
+        self.instrument = instrument
+        self.header = header
+        self.regex = re.compile(pattern) if pattern is not None else None
+        self.kind = kind
+        self.minimum = minimum
+        self.maximum = maximum
+        self.write_format = write_format
+        self.reset()
+
+    def reset(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, elapsed: float) -> None:
+        self.calls += 1
+        self.total += elapsed
+        if elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+    def validate(self, value):
+        if self.minimum is not None and value < self.minimum or self.maximum is not None and value > self.maximum:
+            raise ProtocolError("{}: {} is out of range [{}, {}]".format(self.header, value, self.minimum, self.maximum))
+        return value
+
+    def parse(self, answer: str):
+        """
+        応答文字列を値に変換する
+
+        --------
+        :param answer: 'IOUT  0.012A\\r\\n'
+        :return: 0.012
+        """
+        if self.regex is None:
+            return answer.strip()
+        match = self.regex.fullmatch(answer.strip())
+        if match is None:
+            self.errors += 1
+            raise ProtocolError("{}: unexpected answer {!r}".format(self.header, answer))
+        text = match.group(1).replace(" ", "")
+        if self.kind is bool:
+            return int(text) != 0
+        return self.validate(self.kind(text))
+
+    def format(self, value) -> str:
+        return self.write_format.format(self.validate(value))
+
+
+_NUMBER = r"([-+]?\s*\d+(?:\.\d*)?)"
+
+# バイポーラ電源 Kikusui PBX 40-10
+IOUT = Command("power", "IOUT?", r"IOUT\s*" + _NUMBER + r"A", float, -10.5, 10.5)
+ISET = Command("power", "ISET?", r"ISET\s*" + _NUMBER + r"A", float, -10.5, 10.5)
+VOUT = Command("power", "VOUT?", r"VOUT\s*" + _NUMBER + r"V", float, -42.0, 42.0)
+VSET = Command("power", "VSET?", r"VSET\s*" + _NUMBER + r"V", float, -42.0, 42.0)
+IFINE = Command("power", "IFINE?", r"IFINE\s*([-+]?\s*\d+)", int, -128, 127)
+OUT = Command("power", "OUT?", r"OUT\s*(\d+)", bool)
+IDN = Command("power", "IDN?")
+SET_ISET = Command("power", "ISET", kind=float, minimum=-10.0, maximum=10.0, write_format="ISET {0:.3f}")
+SET_IFINE = Command("power", "IFINE", kind=int, minimum=-128, maximum=127, write_format="IFINE {}")
+SET_OUT = Command("power", "OUT", kind=int, minimum=0, maximum=1, write_format="OUT {}")
+
+# ガウスメーター Lakeshore Model 421
+FIELD = Command("gauss", "FIELD?", _NUMBER, float)
+FIELDM = Command("gauss", "FIELDM?")
+UNIT = Command("gauss", "UNIT?")
+RANGE = Command("gauss", "RANGE?", r"(\d)", int, 0, 3)
+GAUSS_IDN = Command("gauss", "*IDN?")
+SET_RANGE = Command("gauss", "RANGE", kind=int, minimum=0, maximum=3, write_format="RANGE {}")
+
+COMMANDS = [IOUT, ISET, VOUT, VSET, IFINE, OUT, IDN, SET_ISET, SET_IFINE, SET_OUT,
+            FIELD, FIELDM, UNIT, RANGE, GAUSS_IDN, SET_RANGE]
+
+
+def query_raw(resource, command: Command) -> str:
+    """
+    問い合わせて応答文字列をそのまま返す
+    """
+    with tracing.span("visa", command.header):
+        start = time.perf_counter()
+        answer = resource.query(command.header)
+        command.record(time.perf_counter() - start)
+    return answer
+
+
+def query(resource, command: Command):
+    """
+    問い合わせて応答を型変換して返す
+
+    Raise
+    -----
+    ProtocolError : 応答が書式に合わない、または値域外のとき
+    """
+    return command.parse(query_raw(resource, command))
+
+
+def query_into(resource, command: Command, buffer, start: int, count: int) -> None:
+    """
+    count回続けて問い合わせ、値をbuffer[start]から順に書き込む
+    bufferの末尾に達したら先頭に戻る
+    統計は1回分の平均時間をcount回分まとめて記録する
+
+    Raise
+    -----
+    ProtocolError : 応答が書式に合わない、または値域外のとき
+    """
+    query = resource.query
+    parse = command.parse
+    header = command.header
+    size = len(buffer)
+    with tracing.span("visa", header, count):
+        begin = time.perf_counter()
+        for k in range(start, start + count):
+            buffer[k % size] = parse(query(header))
+        elapsed = time.perf_counter() - begin
+    if count:
+        mean = elapsed / count
+        command.calls += count - 1
+        command.total += elapsed - mean
+        command.record(mean)
+
+
+def write(resource, command: Command, value) -> None:
+    """
+    値域を確認して書き込む
+
+    Raise
+    -----
+    ProtocolError : 値域外のとき
+    """
+    message = command.format(value)
+    with tracing.span("visa", message):
+        start = time.perf_counter()
+        resource.write(message)
+        command.record(time.perf_counter() - start)
+
+
+def reset_stats() -> None:
+    for command in COMMANDS:
+        command.reset()
+
+
+def stats_table() -> str:
+    """
+    コマンド毎の呼び出し回数と往復時間の表を返す
+    合計時間の多い順に並べる
+    """
+    lines = ["{:<6} {:<8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>5}".format(
+        "inst", "command", "calls", "total[s]", "min[ms]", "mean[ms]", "max[ms]", "err")]
+    for command in sorted(COMMANDS, key=lambda c: c.total, reverse=True):
+        if command.calls == 0 and command.errors == 0:
+            continue
+        lines.append("{:<6} {:<8} {:>7} {:>9.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>5}".format(
+            command.instrument, command.header, command.calls, command.total,
+            command.min * 1000 if command.calls else 0.0, command.mean * 1000, command.max * 1000, command.errors))
+    return "\n".join(lines)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+掃引レシピ
+
+掃引の形を JSON または TOML のファイルで書き、検証してから planner の掃引計画に変換して実行する。
+複数のレシピを並べて渡すと、全て検証してから順に続けて実行する。
+
+    name = "Oe loop"
+    unit = "Oe"          # "Oe" または "mA"
+    start = 0            # 最初に記録せずに移動する値
+    step = 150           # ランプ幅[mA]
+    settle = "field"     # "point": IOUTのみで安定判定 "field": 磁界の変化率も判定
+    gauss_range = 300
+    memo = "sample A"
+
+    [[segment]]          # 直前の点から to まで mesh ごとに記録する
+    to = 100
+    mesh = 10
+    dwell = 0.0          # 安定後に追加で待つ時間[sec] (省略時はレシピの値)
+    samples = 1          # 1点あたりのFIELD読み取り回数 (省略時はレシピの値)
+    direction = "up"     # 省略可 書いた場合は start/前の区間からの向きと一致するか確かめる
+
+    [[segment]]
+    to = -100
+    mesh = 10
+"""
+import json
+import os
+import sys
+
+import helmcoil
+import planner
+
+try:
+    import tomllib
+except ImportError:  # Python 3.10以前はJSONのみ
+    tomllib = None
+
+UNITS = {"Oe", "mA"}
+SETTLES = {"point": helmcoil.POINT_SETTLE, "field": helmcoil.POINT_FIELD_SETTLE}
+CURRENT_LIMIT = 10000  # mA単位のレシピで許す最大電流[mA]
+RECIPE_KEYS = {"name", "unit", "start", "step", "settle", "gauss_range", "memo", "dwell", "samples",
+               "return_to_zero", "segment"}
+SEGMENT_KEYS = {"to", "mesh", "dwell", "samples", "direction", "log"}
+
+
+class RecipeError(ValueError):
+    """
+    レシピの書式または値の誤り
+    """
+
+
+class Segment:
+    """
+    直前の点から to まで mesh ごとに進む区間
+    """
+
+    def __init__(self, to: int, mesh: int, dwell: float, samples: int, log: bool = True):
+        self.to = to
+        self.mesh = mesh
+        self.dwell = dwell
+        self.samples = samples
+        self.log = log
+
+
+class Recipe:
+    """
+    検証済みのレシピ
+    """
+
+    def __init__(self, name: str, unit: str, start: int, step: int, settle: str, gauss_range: int, memo: str,
+                 segments: list, return_to_zero: bool = True, filename: str = ""):
+        self.name = name
+        self.unit = unit
+        self.start = start
+        self.step = step
+        self.settle = settle
+        self.gauss_range = gauss_range
+        self.memo = memo
+        self.segments = segments
+        self.return_to_zero = return_to_zero
+        self.filename = filename
+
+    def compile(self, start_current: int) -> list:
+        """
+        区間ごとの掃引計画にする 磁界から電流への換算は全点まとめて1回で行う
+
+        Raise
+        -----
+        ControlError : Oe_LIMITまたは校正範囲を超えるとき
+
+        --------
+        :param start_current: 現在の設定電流[mA]
+        :return: [(SweepPlan, Segment), ...]
+        """
+        values = [self.start]
+        bounds = []
+        previous = self.start
+        for segment in self.segments:
+            first = len(values)
+            values.extend(list(planner.segment(previous, segment.to, segment.mesh))[1:])
+            values.append(segment.to)
+            bounds.append((first, len(values)))
+            previous = segment.to
+        currents = helmcoil.fields_to_ma(values) if self.unit == "Oe" else list(values)
+
+        plans = []
+        position = start_current
+        first_plan = planner.SweepPlan(self.unit)
+        first_plan.ramp(position, currents[0], self.step)
+        position = currents[0]
+        for (first, end), segment in zip(bounds, self.segments):
+            plan = first_plan if first_plan is not None else planner.SweepPlan(self.unit)
+            first_plan = None
+            for k in range(first, end):
+                plan.ramp(position, currents[k], self.step, segment.log, values[k])
+                position = currents[k]
+            plans.append((plan, segment))
+        return plans
+
+    def estimate_seconds(self, plans: list) -> float:
+        return sum(plan.estimate_seconds() +
+                   plan.point_count() * (segment.dwell + (segment.samples - 1) * planner.FIELD_SECOND)
+                   for plan, segment in plans)
+
+    def describe(self, plans: list) -> str:
+        points = sum(plan.point_count() for plan, _ in plans)
+        writes = sum(len(plan) for plan, _ in plans)
+        lines = ["[{}] {} 区間 / ISET書き込み {} 回 / 測定点 {} 点 / 予想時間 {:.0f} 秒".format(
+            self.name, len(plans), writes, points, self.estimate_seconds(plans))]
+        position = self.start
+        for (plan, segment) in plans:
+            lines.append("  {:+g} => {:+g} {} mesh {} : {} 点 dwell {} s x{}".format(
+                position, segment.to, self.unit, segment.mesh, plan.point_count(), segment.dwell, segment.samples))
+            position = segment.to
+        return "\n".join(lines)
+
+
+def _number(entry: dict, key: str, kind, default=None, minimum=None, maximum=None):
+    value = entry.get(key, default)
+    if value is None:
+        raise RecipeError("'{}' がありません".format(key))
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+        raise RecipeError("'{}' は{}で指定してください: {!r}".format(key, "整数" if kind is int else "数値", value))
+    value = kind(value)
+    if minimum is not None and value < minimum or maximum is not None and value > maximum:
+        raise RecipeError("'{}' = {} は {}..{} の範囲外です".format(key, value, minimum, maximum))
+    return value
+
+
+def parse(data: dict, filename: str = "") -> Recipe:
+    """
+    辞書からレシピを作る
+
+    Raise
+    -----
+    RecipeError : 書式または値の誤り
+    """
+    unknown = set(data) - RECIPE_KEYS
+    if unknown:
+        raise RecipeError("不明な項目: " + ", ".join(sorted(unknown)))
+    unit = data.get("unit", "Oe")
+    if unit not in UNITS:
+        raise RecipeError("unit は Oe または mA です: {!r}".format(unit))
+    limit = helmcoil.Oe_LIMIT if unit == "Oe" else CURRENT_LIMIT
+    settle = data.get("settle", "field" if unit == "Oe" else "point")
+    if settle not in SETTLES:
+        raise RecipeError("settle は {} のいずれかです: {!r}".format("/".join(SETTLES), settle))
+    dwell = _number(data, "dwell", float, 0.0, 0.0)
+    samples = _number(data, "samples", int, helmcoil.FIELD_SAMPLES, 1, len(helmcoil.FIELD_RING.buffer))
+    start = _number(data, "start", int, 0, -limit, limit)
+
+    entries = data.get("segment")
+    if not isinstance(entries, list) or not entries:
+        raise RecipeError("segment が1つもありません")
+    segments = []
+    previous = start
+    for k, entry in enumerate(entries):
+        try:
+            if not isinstance(entry, dict):
+                raise RecipeError("区間は表で指定してください")
+            unknown = set(entry) - SEGMENT_KEYS
+            if unknown:
+                raise RecipeError("不明な項目: " + ", ".join(sorted(unknown)))
+            to = _number(entry, "to", int, None, -limit, limit)
+            mesh = _number(entry, "mesh", int, None, 1)
+            direction = entry.get("direction")
+            if direction is not None:
+                if direction not in {"up", "down"}:
+                    raise RecipeError("direction は up または down です: {!r}".format(direction))
+                if (to > previous and direction != "up") or (to < previous and direction != "down"):
+                    raise RecipeError("{} => {} は direction = {} と逆向きです".format(previous, to, direction))
+            segments.append(Segment(to, mesh, _number(entry, "dwell", float, dwell, 0.0),
+                                    _number(entry, "samples", int, samples, 1, len(helmcoil.FIELD_RING.buffer)),
+                                    bool(entry.get("log", True))))
+            previous = to
+        except RecipeError as e:
+            raise RecipeError("segment[{}]: {}".format(k, e))
+
+    name = str(data.get("name") or os.path.splitext(os.path.basename(filename))[0] or "recipe")
+    return Recipe(name, unit, start, _number(data, "step", int, 150 if unit == "Oe" else 100, 1, 300), settle,
+                  _number(data, "gauss_range", int, 300, 0), str(data.get("memo", "")), segments,
+                  bool(data.get("return_to_zero", True)), filename)
+
+
+def load(filename: str) -> Recipe:
+    """
+    .toml または .json のレシピを読み込んで検証する
+
+    Raise
+    -----
+    RecipeError : 読み込めない、または書式や値の誤り
+    """
+    try:
+        if filename.endswith(".toml"):
+            if tomllib is None:
+                raise RecipeError("TOMLの読み込みには Python 3.11 以降が必要です")
+            with open(filename, mode="rb") as f:
+                data = tomllib.load(f)
+        else:
+            with open(filename, encoding="utf-8") as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        if isinstance(e, RecipeError):
+            raise
+        raise RecipeError("{}: {}".format(filename, e))
+    if not isinstance(data, dict):
+        raise RecipeError("{}: レシピは表(オブジェクト)で書いてください".format(filename))
+    try:
+        return parse(data, filename)
+    except RecipeError as e:
+        raise RecipeError("{}: {}".format(filename, e))
+
+
+def execute(recipe: Recipe) -> None:
+    """
+    レシピを実行して open_session() の形式で保存する
+
+    Raise
+    -----
+    ControlError : 機器制御や磁界換算に失敗したとき
+    """
+    helmcoil.allow_power_output(True)
+    helmcoil.set_gauss_range(recipe.gauss_range)
+    plans = recipe.compile(helmcoil.A_to_mA(helmcoil.FetchIset()))
+    print(recipe.describe(plans))
+
+    samples = helmcoil.FIELD_SAMPLES
+    try:
+        with helmcoil.open_session(helmcoil.get_time_str() + recipe.name) as session:
+            start_time = session.write_header(recipe.memo)
+            for plan, segment in plans:
+                helmcoil.FIELD_SAMPLES = segment.samples
+                helmcoil.run_plan(plan, session, start_time, SETTLES[recipe.settle], echo=True, dwell=segment.dwell)
+                if recipe.unit == "Oe":
+                    helmcoil.set_last_field(segment.to)
+    finally:
+        helmcoil.FIELD_SAMPLES = samples
+    if recipe.return_to_zero:
+        if recipe.unit == "Oe":
+            helmcoil.return_to_zero(recipe.segments[-1].to)
+        else:
+            helmcoil.ctl_iout_ma(0)
+
+
+def run_queue(filenames: list, dry_run: bool = False) -> int:
+    """
+    レシピを全て検証してから順に実行する 途中で機器制御に失敗したら残りは実行しない
+
+    --------
+    :param filenames: レシピのファイル名
+    :param dry_run:   検証と点数・予想時間の表示だけ行う
+    :return: 実行(dry_runでは検証)できたレシピの数
+    """
+    try:
+        recipes = [load(filename) for filename in filenames]
+        # 換算の範囲外なども実行前に見つけるため、全レシピを一度計画にする
+        start_current = helmcoil.A_to_mA(helmcoil.FetchIset()) if not dry_run else 0
+        compiled = [recipe.compile(start_current) for recipe in recipes]
+    except (RecipeError, helmcoil.ControlError) as e:
+        print("[ERROR]" + getattr(e, "message", str(e)))
+        return 0
+    total = sum(recipe.estimate_seconds(plans) for recipe, plans in zip(recipes, compiled))
+    for recipe, plans in zip(recipes, compiled):
+        print(recipe.describe(plans))
+    print("{} 件 合計予想時間 {:.0f} 秒".format(len(recipes), total))
+    if dry_run:
+        return len(recipes)
+
+    for k, recipe in enumerate(recipes):
+        print("=== {}/{} {} ===".format(k + 1, len(recipes), recipe.name))
+        try:
+            execute(recipe)
+        except helmcoil.ControlError as e:
+            print("[FATAL]{} で中断しました: {}".format(recipe.name, e.message))
+            return k
+    print("Done")
+    return len(recipes)
+
+
+if __name__ == '__main__':
+    # python recipe.py [--dry-run] recipe1.toml recipe2.json ...
+    arguments = sys.argv[1:]
+    dry = "--dry-run" in arguments
+    queue = [name for name in arguments if name != "--dry-run"]
+    if dry:
+        run_queue(queue, dry_run=True)
+    else:
+        helmcoil.init()
+        try:
+            run_queue(queue)
+        finally:
+            helmcoil.after_operations()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+バイナリ形式の測定データ
+
+    先頭 HEADER_SIZE バイト : MAGIC(8) + メタデータ長(uint32 LE) + メタデータ(JSON, UTF-8) + 0埋め
+    以降                    : 1点 = COLUMNS の順に float64 LE を並べた固定長レコード
+
+追記は1点分をまとめて1回で書き込むので、途中で落ちても末尾の不完全なレコードを捨てれば読める。
+読み込みは mmap してそのまま float64 の列として扱うので、長時間の測定でも解析し直す必要がない。
+終了時刻はcloseの時にヘッダ内のメタデータを書き換えて記録する。
+"""
+import csv
+import datetime
+import json
+import mmap
+import os
+import struct
+
+import tracing
+
+MAGIC = b"HCRUN\x00\x01\x00"
+HEADER_SIZE = 4096
+# StatusList.out_tuple() と同じ並び
+COLUMNS = ["diff_second", "iset", "iout", "field", "vout", "ifine", "settle_second", "field_std", "field_count"]
+INT_COLUMNS = {"diff_second", "ifine", "field_count"}
+RECORD = struct.Struct("<{}d".format(len(COLUMNS)))
+
+
+def _pack_header(meta: dict) -> bytes:
+    body = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    header = MAGIC + struct.pack("<I", len(body)) + body
+    if len(header) > HEADER_SIZE:
+        raise ValueError("run metadata too large ({} bytes)".format(len(header)))
+    return header + b"\x00" * (HEADER_SIZE - len(header))
+
+
+def _unpack_header(data) -> dict:
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not a run file")
+    (length,) = struct.unpack_from("<I", data, len(MAGIC))
+    start = len(MAGIC) + 4
+    return json.loads(bytes(data[start:start + length]).decode("utf-8"))
+
+
+class RunSession:
+    """
+    バイナリ形式で測定データを追記する
+    CsvSession と同じ使い方ができる
+    """
+
+    def __init__(self, filename: str, labels: list, fsync: bool = False):
+        """
+        --------
+        :param filename: 書き込むファイル名
+        :param labels:   CSV書き出し時の列見出し
+        :param fsync:    1点書くごとにfsyncするか
+        """
+        self.filename = filename
+        self.labels = labels
+        self.fsync = fsync
+        self.meta = None
+        self._file = None
+
+    def open(self) -> "RunSession":
+        if self._file is None:
+            self._file = open(self.filename, mode="a+b")
+        return self
+
+    def __enter__(self) -> "RunSession":
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def write_header(self, memo: str) -> datetime.datetime:
+        start_time = datetime.datetime.now()
+        self.meta = {"start": start_time.strftime('%Y-%m-%d_%H-%M-%S'), "memo": memo, "end": None,
+                     "columns": COLUMNS, "labels": self.labels}
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(_pack_header(self.meta))
+        self.flush()
+        return start_time
+
+    def add_status(self, status) -> None:
+        self.writerow(status.out_tuple())
+
+    def writerow(self, row) -> None:
+        with tracing.span("csv", "writerow"):
+            self._file.write(RECORD.pack(*[float(v) for v in row]))
+            self.flush()
+
+    def flush(self) -> None:
+        with tracing.span("csv", "flush"):
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """
+        終了時刻をヘッダに書き込んで閉じる
+        """
+        if self._file is None:
+            return
+        try:
+            if self.meta is not None:
+                self.meta["end"] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                with open(self.filename, mode="r+b") as f:
+                    f.write(_pack_header(self.meta))
+        finally:
+            self._file.close()
+            self._file = None
+
+
+class RunFile:
+    """
+    バイナリ形式の測定データを mmap して読む
+
+    column() の memoryview はファイルを直接参照するので、close() (withを抜けたとき) に解放され使えなくなる
+    閉じた後も使う値は list(run.column("field")) などでコピーしておく
+
+    --------
+    with RunFile(path) as run:
+        field = run.column("field")   # float64 の memoryview
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, mode="rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.meta = _unpack_header(self._map)
+        self.count = (len(self._map) - HEADER_SIZE) // RECORD.size
+        self._body = memoryview(self._map)[HEADER_SIZE:HEADER_SIZE + self.count * RECORD.size]
+        self.values = self._body.cast("d")
+        self._views = []  # column() で渡したビュー mmapを閉じる前に全て解放する
+
+    def __enter__(self) -> "RunFile":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        """
+        渡したビューを全て解放してから mmap を閉じる
+        """
+        for view in self._views:
+            view.release()
+        self._views = []
+        self.values.release()
+        self._body.release()
+        self._map.close()
+
+    def column(self, name: str) -> memoryview:
+        """
+        1列分の値 コピーせずにファイルを直接参照する close() の後は使えない
+        """
+        view = self.values[COLUMNS.index(name)::len(COLUMNS)]
+        self._views.append(view)
+        return view
+
+    def rows(self):
+        width = len(COLUMNS)
+        ints = [name in INT_COLUMNS for name in COLUMNS]
+        for k in range(self.count):
+            # ビューを残さないようリストにしてから返す
+            record = self.values[k * width:(k + 1) * width].tolist()
+            yield tuple(int(v) if is_int else v for v, is_int in zip(record, ints))
+
+
+def load_numpy(filename: str):
+    """
+    numpy.memmap の構造化配列として読む numpyが必要
+
+    --------
+    :return: (メタデータ, 配列)
+    """
+    import numpy
+
+    with open(filename, mode="rb") as f:
+        meta = _unpack_header(f.read(HEADER_SIZE))
+    count = (os.path.getsize(filename) - HEADER_SIZE) // RECORD.size
+    dtype = numpy.dtype([(name, "<f8") for name in COLUMNS])
+    return meta, numpy.memmap(filename, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+def export_csv(run_filename: str, csv_filename: str) -> int:
+    """
+    addSaveStatus() と同じ形式のCSVに書き出す
+
+    --------
+    :return: 書き出した点数
+    """
+    with RunFile(run_filename) as run, open(csv_filename, mode="w", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(["開始時刻", run.meta["start"]])
+        writer.writerow(["memo", run.meta["memo"]])
+        writer.writerow(["#####"])
+        writer.writerow(run.meta["labels"])
+        writer.writerows(run.rows())
+        if run.meta.get("end"):
+            writer.writerow(["終了時刻", run.meta["end"]])
+        return len(run)
+
+
+def check() -> None:
+    """
+    一時ファイルに書いて RunFile の使い方の例の通りに読めるか確かめる
+
+    Raise
+    -----
+    AssertionError : 書いた値と読んだ値が合わないとき
+    """
+    import tempfile
+
+    class _Status:
+        def __init__(self, k: int):
+            self.row = (k, 0.1 * k, 0.1 * k, 2.0 * k, 0.4 * k, 0, 0.0, 0.0, 1)
+
+        def out_tuple(self) -> tuple:
+            return self.row
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "check.run")
+    try:
+        with RunSession(path, COLUMNS) as session:
+            session.write_header("check")
+            for k in range(5):
+                session.add_status(_Status(k))
+        with RunFile(path) as run:
+            field = run.column("field")
+            assert list(field) == [2.0 * k for k in range(5)]
+            assert [row[0] for row in run.rows()] == list(range(5))
+        try:
+            # 閉じた後のビューは解放されている
+            field[0]
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("column view is still alive after close()")
+        csv_path = os.path.join(directory, "check.csv")
+        assert export_csv(path, csv_path) == 5
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    # python runfile.py : 読み書きの確認
+    check()
+    print("ok")
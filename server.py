@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+機器を持つローカル制御サーバ
+
+このプロセスだけが機器を開き、他の人や監視スクリプトは localhost の HTTP で JSON-RPC 2.0 を呼ぶ。
+status は StatusFeed が一定間隔で1回だけ取得した共有の値を返すので、何台のクライアントが
+問い合わせてもバスへの問い合わせは1組で済む。制御中は掃引が読んだ値(helmcoil.STATUS_CACHE)と
+記録点を共有値にし、掃引のバスをほとんど使わない。
+制御(電流、磁界、掃引)はジョブとして1つずつ実行し、WATCHDOG の監視下で動かす。
+
+    python server.py [port]
+
+    import server
+    server.call("status")
+    server.call("ctl_magnetic_field", field=50)   # => {"job": 1}
+    server.call("job", job=1)
+
+メソッド
+    status                         共有のステータス (age は取得からの経過秒)
+    ctl_iout_ma(current)           電流を current[mA] にする
+    ctl_magnetic_field(field)      磁界を field[Oe] にする
+    sweep(recipe)                  recipe.py のレシピ(辞書)を検証して実行する
+    stop(reason)                   実行中のジョブを止めて電流を0まで下げる
+    job(job)                       ジョブの状態 省略時は最新のジョブ
+    health                         接続状態
+"""
+import http.server
+import json
+import sys
+import threading
+import time
+import urllib.request
+
+import helmcoil
+
+HOST = "127.0.0.1"  # 外部には公開しない
+PORT = 8765
+STATUS_PERIOD = 1.0  # 待機中にステータスを取り直す間隔[sec]
+BUSY_MAX_AGE = 5.0   # 制御中に許す古さ[sec] これより古い項目だけ問い合わせる
+
+# JSON-RPC 2.0 のエラーコード
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+CONTROL_ERROR = -32000
+BUSY = -32001
+
+
+class RpcError(Exception):
+    def __init__(self, code: int, message: str):
+        self.code = code
+        self.message = message
+
+
+def status_dict(status: helmcoil.StatusList, acquired: float) -> dict:
+    return {"iset": status.iset, "iout": status.iout, "vout": status.vout, "field": status.field,
+            "field_std": status.field_std, "field_count": status.field_count, "ifine": status.ifine,
+            "time": acquired}
+
+
+class StatusFeed:
+    """
+    共有のステータス 待機中は period ごとに loadStatus() し、
+    制御中は掃引が読んだ値を STATUS_CACHE から集め、記録点は publish() された値に置き換える
+    """
+
+    def __init__(self, period: float = STATUS_PERIOD):
+        self.period = period
+        self.paused = threading.Event()
+        self.refreshes = 0  # バスへ問い合わせた回数
+        self.served = 0     # クライアントへ返した回数
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="status-feed", daemon=True)
+
+    def start(self) -> "StatusFeed":
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def publish(self, status: helmcoil.StatusList) -> None:
+        acquired = time.time()
+        if status.acquired:
+            # 写しを使った項目があれば、最も古い項目の取得時刻にする
+            acquired -= time.monotonic() - min(status.acquired.values())
+        with self._lock:
+            self._snapshot = status_dict(status, acquired)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self.served += 1
+            if self._snapshot is None:
+                raise RpcError(CONTROL_ERROR, "status is not available yet: {}".format(self.last_error))
+            result = dict(self._snapshot)
+        result["age"] = round(time.time() - result["time"], 3)
+        result["busy"] = self.paused.is_set()
+        return result
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                if self.paused.is_set():
+                    self.publish(helmcoil.loadStatus(max_age=BUSY_MAX_AGE))
+                else:
+                    self.publish(helmcoil.loadStatus(max_age=self.period, ages=helmcoil.STATUS_AGES))
+                    self.refreshes += 1
+                self.last_error = None
+            except Exception as e:
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+            self._stop.wait(max(0.0, self.period - (time.monotonic() - start)))
+
+
+class _PublishingSession:
+    """
+    open_session() の書き込み先を包み、記録点を StatusFeed にも渡す
+    """
+
+    def __init__(self, session, feed: StatusFeed):
+        self.session = session
+        self.feed = feed
+
+    def __enter__(self):
+        self.session.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.session.__exit__(exc_type, exc_val, exc_tb)
+
+    def add_status(self, status) -> None:
+        self.session.add_status(status)
+        self.feed.publish(status)
+
+    def __getattr__(self, name: str):
+        return getattr(self.session, name)
+
+
+class Job:
+    def __init__(self, number: int, method: str, params: dict):
+        self.number = number
+        self.method = method
+        self.params = params
+        self.state = "running"  # running / done / failed
+        self.stoppable = True   # rpc_stop を受け付けるか WATCHDOG を抜ける前に落とす
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def as_dict(self) -> dict:
+        return {"job": self.number, "method": self.method, "params": self.params, "state": self.state,
+                "result": self.result, "error": self.error, "started": self.started, "finished": self.finished}
+
+
+class ControlServer:
+    """
+    RPCの受付と、制御ジョブを1つずつ実行するスレッド
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT, period: float = STATUS_PERIOD):
+        self.feed = StatusFeed(period)
+        self.jobs = []
+        self._job_lock = threading.Lock()
+        self._open_session = helmcoil.open_session
+        self.methods = {
+            "status": self.rpc_status,
+            "health": self.rpc_health,
+            "job": self.rpc_job,
+            "stop": self.rpc_stop,
+            "ctl_iout_ma": self.rpc_ctl_iout_ma,
+            "ctl_magnetic_field": self.rpc_ctl_magnetic_field,
+            "sweep": self.rpc_sweep,
+        }
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.control = self
+
+    def serve_forever(self) -> None:
+        # 記録点を共有値にするため、このプロセスの掃引は全て包んだ書き込み先に保存する
+        helmcoil.open_session = lambda basename: _PublishingSession(self._open_session(basename), self.feed)
+        self.feed.start()
+        host, port = self.httpd.server_address[:2]
+        print("JSON-RPC server on http://{}:{}/".format(host, port))
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.feed.close()
+            helmcoil.open_session = self._open_session
+
+    def shutdown(self) -> None:
+        self.httpd.shutdown()
+
+    def dispatch(self, request) -> dict:
+        """
+        1件のJSON-RPCリクエストを処理して応答を返す 通知(idなし)はNoneを返す
+        """
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" or \
+                not isinstance(request.get("method"), str):
+            return _error(None, INVALID_REQUEST, "invalid request")
+        number = request.get("id")
+        params = request.get("params", {})
+        try:
+            method = self.methods.get(request["method"])
+            if method is None:
+                raise RpcError(METHOD_NOT_FOUND, "method not found: " + request["method"])
+            if not isinstance(params, dict):
+                raise RpcError(INVALID_PARAMS, "params must be an object")
+            try:
+                result = method(**params)
+            except TypeError as e:
+                raise RpcError(INVALID_PARAMS, str(e))
+        except RpcError as e:
+            return _error(number, e.code, e.message)
+        if "id" not in request:
+            return None
+        return {"jsonrpc": "2.0", "id": number, "result": result}
+
+    # --- メソッド ---
+
+    def rpc_status(self) -> dict:
+        return self.feed.snapshot()
+
+    def rpc_health(self) -> dict:
+        return {"gauss": helmcoil.gauss.report(), "power": helmcoil.power.report(),
+                "status_refreshes": self.feed.refreshes, "status_served": self.feed.served,
+                "status_error": self.feed.last_error}
+
+    def rpc_job(self, job: int = None) -> dict:
+        with self._job_lock:
+            if not self.jobs:
+                raise RpcError(INVALID_PARAMS, "no job")
+            if job is None:
+                return self.jobs[-1].as_dict()
+            if not isinstance(job, int) or not 1 <= job <= len(self.jobs):
+                raise RpcError(INVALID_PARAMS, "unknown job: {!r}".format(job))
+            return self.jobs[job - 1].as_dict()
+
+    def rpc_stop(self, reason: str = "stopped by client") -> dict:
+        with self._job_lock:
+            # 確認と停止の間にジョブが終わって、待機中の WATCHDOG を落とさないよう同じロックの中で止める
+            job = self.jobs[-1] if self.jobs else None
+            if job is None or not job.stoppable:
+                raise RpcError(INVALID_PARAMS, "no running job")
+            helmcoil.WATCHDOG.stop(str(reason))
+            return {"job": job.number}
+
+    def rpc_ctl_iout_ma(self, current) -> dict:
+        current = _integer(current, "current", -10000, 10000)
+
+        def run():
+            helmcoil.allow_power_output(True)
+            return helmcoil.ctl_iout_ma(current)
+        return self._submit("ctl_iout_ma", {"current": current}, run)
+
+    def rpc_ctl_magnetic_field(self, field) -> dict:
+        field = _integer(field, "field", -helmcoil.Oe_LIMIT, helmcoil.Oe_LIMIT)
+
+        def run():
+            helmcoil.allow_power_output(True)
+            return helmcoil.ctl_magnetic_field(field)
+        return self._submit("ctl_magnetic_field", {"field": field}, run)
+
+    def rpc_sweep(self, recipe: dict) -> dict:
+        import recipe as recipes
+
+        try:
+            parsed = recipes.parse(recipe)
+        except recipes.RecipeError as e:
+            raise RpcError(INVALID_PARAMS, str(e))
+        return self._submit("sweep", {"recipe": parsed.name}, lambda: recipes.execute(parsed))
+
+    # --- ジョブ ---
+
+    def _submit(self, method: str, params: dict, function) -> dict:
+        with self._job_lock:
+            if self.jobs and self.jobs[-1].state == "running":
+                raise RpcError(BUSY, "job {} ({}) is running".format(self.jobs[-1].number, self.jobs[-1].method))
+            job = Job(len(self.jobs) + 1, method, params)
+            self.jobs.append(job)
+            self.feed.paused.set()
+        threading.Thread(target=self._run_job, args=(job, function), name="job-{}".format(job.number),
+                         daemon=True).start()
+        return {"job": job.number}
+
+    def _run_job(self, job: Job, function) -> None:
+        try:
+            with helmcoil.WATCHDOG:
+                try:
+                    job.result = function()
+                finally:
+                    # ここから先の rpc_stop はこのジョブに届かない
+                    with self._job_lock:
+                        job.stoppable = False
+            job.state = "done"
+        except helmcoil.ControlError as e:
+            job.error = e.message
+            job.state = "failed"
+        except Exception as e:
+            job.error = "{}: {}".format(type(e).__name__, e)
+            job.state = "failed"
+        finally:
+            job.finished = time.time()
+            self.feed.paused.clear()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError as e:
+            self._reply(_error(None, PARSE_ERROR, "parse error: {}".format(e)))
+            return
+        control = self.server.control
+        if isinstance(request, list):
+            responses = [response for response in map(control.dispatch, request) if response is not None]
+            self._reply(responses or None)
+        else:
+            self._reply(control.dispatch(request))
+
+    def _reply(self, response) -> None:
+        if response is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+        body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _error(number, code: int, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": number, "error": {"code": code, "message": message}}
+
+
+def _integer(value, name: str, minimum: int, maximum: int) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value):
+        raise RpcError(INVALID_PARAMS, "{} must be an integer: {!r}".format(name, value))
+    if not minimum <= value <= maximum:
+        raise RpcError(INVALID_PARAMS, "{} = {} is out of range {}..{}".format(name, value, minimum, maximum))
+    return int(value)
+
+
+def call(method: str, host: str = HOST, port: int = PORT, timeout: float = 10.0, **params):
+    """
+    クライアント側 サーバのメソッドを呼んで result を返す
+
+    Raise
+    -----
+    RpcError : サーバがエラーを返したとき
+    """
+    request = json.dumps({"jsonrpc": "2.0", "id": 1, "method": method, "params": params}).encode("utf-8")
+    http_request = urllib.request.Request("http://{}:{}/".format(host, port), data=request,
+                                          headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(http_request, timeout=timeout) as response:
+        reply = json.loads(response.read().decode("utf-8"))
+    if "error" in reply:
+        raise RpcError(reply["error"]["code"], reply["error"]["message"])
+    return reply["result"]
+
+
+def serve(port: int = PORT) -> None:
+    helmcoil.init()
+    server = ControlServer(port=port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        helmcoil.after_operations()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else PORT)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+PBX 40-10 / Model 421 のプロセス内シミュレータ
+
+helmcoil.DEBUG = True のときに実機の代わりに使う。
+pyvisa のリソースと同じ query()/write() を持ち、実機と同じ応答文字列を返す。
+コマンド毎の通信遅延、コイルの L/R 応答、電源のコンプライアンス電圧、
+磁界ノイズとヒステリシスを模擬するので、実機を使わずに測定シーケンスの所要時間を計測できる。
+"""
+import random
+import threading
+import time
+
+# コマンド毎の既定遅延[sec] GPIB は 1往復 10ms 前後、RS-232(9600bps) は 30ms 以上かかる
+PBX_LATENCY = {
+    "IOUT?": 0.012,
+    "ISET?": 0.012,
+    "VOUT?": 0.012,
+    "VSET?": 0.012,
+    "IFINE?": 0.012,
+    "OUT?": 0.012,
+    "IDN?": 0.015,
+    "write": 0.008,
+}
+
+GAUSS_LATENCY = {
+    "FIELD?": 0.035,
+    "FIELDM?": 0.030,
+    "UNIT?": 0.030,
+    "RANGE?": 0.030,
+    "*IDN?": 0.040,
+    "write": 0.025,
+}
+
+# Model 421 のレンジ番号 => (フルスケール[G], 応答の書式, 表示倍率, FIELDM の応答)
+GAUSS_RANGES = {
+    0: (30000.0, "{:.3f}", 1e-3, "k"),
+    1: (3000.0, "{:.0f}", 1.0, ""),
+    2: (300.0, "{:.1f}", 1.0, ""),
+    3: (30.0, "{:.2f}", 1.0, ""),
+}
+
+
+class CoilModel:
+    """
+    ヘルムホルツコイルと電源の電流ループ
+
+    電源は時定数 loop_tau で ISET に追従しようとするが、
+    必要な電圧 R*i + L*di/dt が vmax を超える場合は vmax でクリップされ、電流変化率が制限される。
+    """
+
+    def __init__(self, inductance: float = 0.3, resistance: float = 4.0, loop_tau: float = 0.02,
+                 vmax: float = 40.0, imax: float = 10.0, oe_per_a: float = 20.960,
+                 hysteresis_oe: float = 0.3, noise_oe: float = 0.05, offset_ma: float = 2.5,
+                 fine_lsb_ma: float = 0.1):
+        """
+        --------
+        :param inductance:  コイルのインダクタンス[H]
+        :param resistance:  コイルの抵抗[Ω]
+        :param loop_tau:    電源電流ループの時定数[sec]
+        :param vmax:        コンプライアンス電圧[V]
+        :param imax:        最大出力電流[A]
+        :param oe_per_a:    コイル定数[Oe/A]
+        :param hysteresis_oe: 磁界のヒステリシス幅(片側)[Oe]
+        :param noise_oe:    磁界ノイズの標準偏差[Oe]
+        :param offset_ma:   出力電流のオフセット誤差[mA]
+        :param fine_lsb_ma: IFINE 1カウントあたりの電流[mA]
+        """
+        self.inductance = inductance
+        self.resistance = resistance
+        self.loop_tau = loop_tau
+        self.vmax = vmax
+        self.imax = imax
+        self.oe_per_a = oe_per_a
+        self.hysteresis_oe = hysteresis_oe
+        self.noise_oe = noise_oe
+        self.offset_ma = offset_ma
+        self.fine_lsb_ma = fine_lsb_ma
+
+        self.output = False
+        self.iset = 0.0
+        self.ifine = 0
+        self.current = 0.0
+        self.didt = 0.0
+        self.play_oe = 0.0
+        self.lock = threading.RLock()
+        self._last = time.monotonic()
+
+    def target(self) -> float:
+        if not self.output:
+            return 0.0
+        i = self.iset + (self.offset_ma + self.ifine * self.fine_lsb_ma) / 1000
+        return max(-self.imax, min(self.imax, i))
+
+    def advance(self) -> None:
+        """
+        前回呼び出しからの経過時間だけ電流を積分する
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self._last
+            self._last = now
+            target = self.target()
+            if abs(target - self.current) < 1e-7 and abs(self.didt) < 1e-6:
+                self.current = target
+                self.didt = 0.0
+                self._update_play()
+                return
+            dt = self.loop_tau / 10
+            while elapsed > 0:
+                h = min(dt, elapsed)
+                want = (target - self.current) / self.loop_tau
+                v = self.resistance * self.current + self.inductance * want
+                v = max(-self.vmax, min(self.vmax, v))
+                self.didt = (v - self.resistance * self.current) / self.inductance
+                step = self.didt * h
+                if (target - self.current) * (target - self.current - step) <= 0:
+                    self.current = target
+                    self.didt = 0.0
+                    break
+                self.current += step
+                elapsed -= h
+            self._update_play()
+
+    def _update_play(self) -> None:
+        # play operator: 磁界はコイル電流に対して ±hysteresis_oe の遊びを持って追従する
+        h = self.current * self.oe_per_a
+        w = self.hysteresis_oe
+        self.play_oe = max(h - w, min(h + w, self.play_oe))
+
+    def voltage(self) -> float:
+        self.advance()
+        return self.resistance * self.current + self.inductance * self.didt
+
+    def field_oe(self) -> float:
+        self.advance()
+        return self.play_oe + random.gauss(0.0, self.noise_oe)
+
+
+class SimulatedInstrument:
+    """
+    pyvisa の Resource と同じ query()/write() を持つ模擬機器の基底クラス
+    """
+    IDN = ""
+
+    def __init__(self, coil: CoilModel, latency: dict = None, latency_scale: float = 1.0):
+        self.coil = coil
+        self.latency = dict(latency or {})
+        self.latency_scale = latency_scale
+        self.timeout = 2000
+        self.counter = {}
+
+    def _wait(self, key: str) -> None:
+        self.counter[key] = self.counter.get(key, 0) + 1
+        delay = self.latency.get(key, self.latency.get("write", 0.0)) * self.latency_scale
+        if delay > 0:
+            time.sleep(delay)
+
+    def query(self, command: str) -> str:
+        command = command.strip()
+        self._wait(command.split(" ")[0])
+        return self._answer(command)
+
+    def write(self, command: str) -> None:
+        self._wait("write")
+        self._execute(command.strip())
+
+    def read(self) -> str:
+        return ""
+
+    def close(self) -> None:
+        pass
+
+    def _answer(self, command: str) -> str:
+        raise NotImplementedError
+
+    def _execute(self, command: str) -> None:
+        raise NotImplementedError
+
+
+class SimulatedPBX(SimulatedInstrument):
+    """
+    Kikusui PBX 40-10 バイポーラ電源
+    """
+    IDN = 'IDN PBX 40-10 VER1.13     KIKUSUI    \r\n'
+
+    def __init__(self, coil: CoilModel, latency: dict = None, latency_scale: float = 1.0):
+        super().__init__(coil, latency if latency is not None else PBX_LATENCY, latency_scale)
+        self.vset = 40.0
+
+    def _answer(self, command: str) -> str:
+        coil = self.coil
+        if command == "IOUT?":
+            coil.advance()
+            return "IOUT {:6.3f}A\r\n".format(coil.current)
+        if command == "ISET?":
+            return "ISET {:6.3f}A\r\n".format(coil.iset)
+        if command == "VOUT?":
+            return "VOUT {:6.3f}V\r\n".format(coil.voltage())
+        if command == "VSET?":
+            return "VSET {:6.3f}V\r\n".format(self.vset)
+        if command == "IFINE?":
+            return "IFINE {:4d}\r\n".format(coil.ifine)
+        if command == "OUT?":
+            return "OUT 001\r\n" if coil.output else "OUT 000\r\n"
+        if command == "IDN?":
+            return self.IDN
+        return "ERR\r\n"
+
+    def _execute(self, command: str) -> None:
+        coil = self.coil
+        parts = command.split()
+        if len(parts) != 2:
+            return
+        name, arg = parts
+        with coil.lock:
+            coil.advance()
+            if name == "ISET":
+                coil.iset = max(-coil.imax, min(coil.imax, round(float(arg), 3)))
+            elif name == "IFINE":
+                coil.ifine = max(-128, min(127, int(arg)))
+            elif name == "OUT":
+                coil.output = arg in {"1", "ON"}
+            elif name == "VSET":
+                self.vset = float(arg)
+
+
+class SimulatedModel421(SimulatedInstrument):
+    """
+    Lakeshore Model 421 ガウスメーター
+    """
+    IDN = 'LSCI,MODEL421,0,010306\r\n'
+
+    def __init__(self, coil: CoilModel, latency: dict = None, latency_scale: float = 1.0):
+        super().__init__(coil, latency if latency is not None else GAUSS_LATENCY, latency_scale)
+        self.range = 0
+
+    def _answer(self, command: str) -> str:
+        full_scale, fmt, scale, multiplier = GAUSS_RANGES[self.range]
+        if command == "FIELD?":
+            gauss = self.coil.field_oe()
+            if abs(gauss) > full_scale:
+                return "OL\r\n"
+            return fmt.format(gauss * scale) + "\r\n"
+        if command == "FIELDM?":
+            return multiplier + "\r\n"
+        if command == "UNIT?":
+            return "G\r\n"
+        if command == "RANGE?":
+            return "{}\r\n".format(self.range)
+        if command == "*IDN?":
+            return self.IDN
+        return "\r\n"
+
+    def _execute(self, command: str) -> None:
+        parts = command.split()
+        if len(parts) == 2 and parts[0] == "RANGE" and int(parts[1]) in GAUSS_RANGES:
+            self.range = int(parts[1])
+
+
+def open_simulated_rig(latency_scale: float = 1.0, **coil_params) -> tuple:
+    """
+    コイルを共有する模擬ガウスメーターと模擬電源を生成する
+
+    --------
+    :param latency_scale: 通信遅延の倍率 0で遅延なし
+    :param coil_params: CoilModel に渡すパラメータ
+    :return: (gauss, power)
+    """
+    coil = CoilModel(**coil_params)
+    return (SimulatedModel421(coil, latency_scale=latency_scale),
+            SimulatedPBX(coil, latency_scale=latency_scale))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+複数の測定ステーション(ヘルムホルツコイル + PBX + Model 421)を1台のPCから同時に動かす
+
+ステーションごとに1つのワーカープロセスを起動し、その中で helmcoil のアドレスと定数を書き換えて
+init() => 掃引 => after_operations() を実行する。
+helmcoil の状態(写し、IFINE表、校正表、シミュレータ)はプロセスごとに独立しているので、
+1台が例外で止まっても他のステーションの測定は続く。
+出力はステーションごとのディレクトリに書き、画面表示は station.log に残す。
+
+stations.json の例:
+    [
+      {"name": "A", "gauss": "ASRL3::INSTR", "power": "GPIB0::4::INSTR", "Oe_CURRENT_CONST": 20.960},
+      {"name": "B", "gauss": "ASRL4::INSTR", "power": "GPIB0::5::INSTR", "FLAG_AUTOFINE": true,
+       "calibration": "calib_B.csv"}
+    ]
+"""
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+STATIONS_FILE = "stations.json"
+SWEEPS = ("Oe_measure", "measure", "cmeasure")
+
+
+class Station:
+    """
+    1台分の機器アドレスと定数
+    """
+
+    def __init__(self, name: str, gauss: str, power: str, oe_current_const: float = 20.960,
+                 autofine: bool = False, calibration: str = None, directory: str = None):
+        """
+        --------
+        :param name:             ステーション名
+        :param gauss:            ガウスメーターのVISAアドレス
+        :param power:            バイポーラ電源のVISAアドレス
+        :param oe_current_const: Oe_CURRENT_CONST [Oe/A]
+        :param autofine:         FLAG_AUTOFINE
+        :param calibration:      磁界-電流校正表 (directoryからの相対パス可)
+        :param directory:        出力先ディレクトリ 省略時はステーション名
+        """
+        self.name = name
+        self.gauss = gauss
+        self.power = power
+        self.oe_current_const = oe_current_const
+        self.autofine = autofine
+        self.calibration = calibration
+        self.directory = directory or name
+
+    def __repr__(self) -> str:
+        return "Station({!r}, {!r}, {!r})".format(self.name, self.gauss, self.power)
+
+    @classmethod
+    def from_dict(cls, entry: dict) -> "Station":
+        return cls(entry["name"], entry["gauss"], entry["power"],
+                   oe_current_const=float(entry.get("Oe_CURRENT_CONST", 20.960)),
+                   autofine=bool(entry.get("FLAG_AUTOFINE", False)),
+                   calibration=entry.get("calibration"),
+                   directory=entry.get("directory"))
+
+    def apply(self) -> None:
+        """
+        このプロセスの helmcoil をこのステーション用に設定する
+        DEBUGのときはアドレスを使わずシミュレータのまま
+        """
+        import connection
+        import helmcoil
+
+        os.makedirs(self.directory, exist_ok=True)
+        os.chdir(self.directory)
+        helmcoil.GAUSS_ADDRESS = self.gauss
+        helmcoil.POWER_ADDRESS = self.power
+        if not helmcoil.DEBUG:
+            helmcoil.gauss = connection.Connection("gauss", self.gauss, "*IDN?")
+            helmcoil.power = connection.Connection("power", self.power, "IDN?")
+        helmcoil.Oe_CURRENT_CONST = self.oe_current_const
+        helmcoil.FLAG_AUTOFINE = self.autofine
+        if self.calibration:
+            helmcoil.load_field_calibration(self.calibration)
+
+
+def load_stations(filename: str = STATIONS_FILE) -> list:
+    """
+    Raise
+    -----
+    OSError, ValueError, KeyError : 読み込めないとき
+    """
+    with open(filename, encoding="utf-8") as f:
+        return [Station.from_dict(entry) for entry in json.load(f)]
+
+
+def _worker(station: Station, sweep: str, memo: str, results) -> None:
+    """
+    ワーカープロセスの本体 結果は (名前, 成否, メッセージ, 所要時間[sec]) を results に入れる
+    """
+    start = time.monotonic()
+    log = None
+    try:
+        station.apply()
+        log = open("station.log", mode="a", encoding="utf-8", buffering=1)
+        sys.stdout = sys.stderr = log
+        import helmcoil
+
+        helmcoil.MEMO = memo
+        helmcoil.init()
+        try:
+            if sweep == "measure":
+                helmcoil.measure()
+            elif sweep == "cmeasure":
+                import continuous
+
+                continuous.continuous_measure()
+            else:
+                helmcoil.Oe_measure()
+        finally:
+            helmcoil.after_operations()
+        results.put((station.name, True, "Done", time.monotonic() - start))
+    except BaseException as e:
+        # init() の sys.exit() も含めてこのステーションだけの失敗として報告する
+        message = getattr(e, "message", None) or "{}: {}".format(type(e).__name__, e)
+        if log is not None:
+            traceback.print_exc()
+        results.put((station.name, False, message, time.monotonic() - start))
+    finally:
+        if log is not None:
+            log.close()
+
+
+def run_stations(stations: list, sweep: str = "Oe_measure", memos: dict = None) -> list:
+    """
+    全ステーションで同時に掃引し、全て終わるまで待つ
+    ワーカーが機器を開けるよう、呼び出し側のプロセスで開いている機器は先に閉じておくこと
+    (シリアルポートは1つのプロセスしか開けない)
+
+    --------
+    :param stations: Station のリスト
+    :param sweep:    SWEEPS のいずれか
+    :param memos:    ステーション名 => memo
+    :return: ステーション毎の (名前, 成否, メッセージ, 所要時間[sec])
+    """
+    if sweep not in SWEEPS:
+        raise ValueError("unknown sweep: " + sweep)
+    memos = memos or {}
+    # VISAのハンドルを子プロセスへ持ち込まないように spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = {}
+    for station in stations:
+        worker = context.Process(target=_worker, name="station-" + station.name,
+                                 args=(station, sweep, memos.get(station.name, ""), results))
+        worker.start()
+        workers[station.name] = worker
+
+    reported = {}
+    while len(reported) < len(workers):
+        for name, worker in workers.items():
+            if name not in reported and not worker.is_alive() and worker.exitcode not in (0, None):
+                # 報告する前にプロセスごと落ちた
+                reported[name] = (name, False, "worker exited with code {}".format(worker.exitcode), 0.0)
+        while not results.empty():
+            result = results.get()
+            reported[result[0]] = result
+        time.sleep(0.2)
+    for worker in workers.values():
+        worker.join()
+    return [reported[station.name] for station in stations]
+
+
+def summary(results: list) -> str:
+    return "\n".join("{:<10} {:<4} {:>7.1f} sec  {}".format(name, "OK" if ok else "FAIL", elapsed, message)
+                     for name, ok, message, elapsed in results)
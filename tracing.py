@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+測定の所要時間の内訳を記録する
+
+VISA の書き込み/問い合わせ、sleep、安定待ち、CSV書き込み、ランプなどを区間(span)として記録し、
+Chrome trace / Perfetto で開ける JSON と、種類ごとの時間の集計表を出力する。
+ENABLED が偽の間は span() は何もしない共有オブジェクトを返すだけなので、測定への影響はほぼない。
+
+    tracing.enable()
+    ...
+    tracing.export_chrome("trace.json")
+    print(tracing.summary())
+"""
+import json
+import threading
+import time
+
+ENABLED = False
+
+_events = []  # (名前, 種類, 詳細, 開始[us], 長さ[us], 自分だけの時間[us], スレッドID)
+_threads = {}
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("category", "name", "detail", "start", "children")
+
+    def __init__(self, category: str, name: str, detail):
+        self.category = category
+        self.name = name
+        self.detail = detail
+        self.children = 0.0
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+            thread = threading.current_thread()
+            _threads[thread.ident] = thread.name
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        duration = end - self.start
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+        _events.append((self.name, self.category, self.detail, (self.start - _origin) * 1e6, duration * 1e6,
+                        (duration - self.children) * 1e6, threading.get_ident()))
+        return False
+
+
+def span(category: str, name: str = None, detail=None):
+    """
+    区間を記録するコンテキストマネージャを返す
+    無効の間に文字列を組み立てないよう、detailは書き出すときに文字列にする
+
+    --------
+    :param category: 種類 "visa" / "sleep" / "settle" / "csv" / "ramp" など
+    :param name:     表示名 省略時は種類と同じ
+    :param detail:   付加情報 (目標電流など)
+    """
+    if not ENABLED:
+        return _NULL
+    return _Span(category, name or category, detail)
+
+
+def sleep(seconds: float) -> None:
+    """
+    time.sleep() を "sleep" 区間として記録する
+    """
+    if not ENABLED:
+        time.sleep(seconds)
+        return
+    with _Span("sleep", "sleep", seconds):
+        time.sleep(seconds)
+
+
+def enable() -> None:
+    global ENABLED
+    ENABLED = True
+
+
+def disable() -> None:
+    global ENABLED
+    ENABLED = False
+
+
+def reset() -> None:
+    global _origin
+    del _events[:]
+    _origin = time.perf_counter()
+
+
+def export_chrome(filename: str) -> int:
+    """
+    Chrome trace 形式(chrome://tracing, ui.perfetto.dev で開ける)で書き出す
+
+    --------
+    :return: 書き出した区間数
+    """
+    events = list(_events)
+    trace = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+             for tid, name in _threads.items()]
+    for name, category, detail, start, duration, _, tid in events:
+        event = {"name": name, "cat": category, "ph": "X", "ts": round(start, 1), "dur": round(duration, 1),
+                 "pid": 1, "tid": tid}
+        if detail is not None:
+            event["args"] = {"detail": str(detail)}
+        trace.append(event)
+    with open(filename, mode="w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    return len(events)
+
+
+def summary() -> str:
+    """
+    種類ごとの時間の集計表
+    入れ子になった区間は内側の区間の時間を差し引いた自分だけの時間で集計するので、合計は実時間を超えない
+    """
+    totals = {}
+    for _, category, _, _, duration, exclusive, _ in list(_events):
+        count, total, self_total = totals.get(category, (0, 0.0, 0.0))
+        totals[category] = (count + 1, total + duration, self_total + exclusive)
+    grand = sum(t[2] for t in totals.values()) or 1.0
+    lines = ["{:<10} {:>8} {:>12} {:>12} {:>7}".format("category", "count", "self[s]", "total[s]", "self%")]
+    for category, (count, total, self_total) in sorted(totals.items(), key=lambda x: x[1][2], reverse=True):
+        lines.append("{:<10} {:>8} {:>12.3f} {:>12.3f} {:>6.1f}%".format(
+            category, count, self_total / 1e6, total / 1e6, self_total / grand * 100))
+    return "\n".join(lines)